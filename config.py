@@ -15,14 +15,96 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_NAME = os.getenv("DB_NAME")
 
+# MySQL для чтения (отчёты, списки) — можно направить на реплику, по умолчанию основной сервер
+DB_READ_HOST = os.getenv("DB_READ_HOST", DB_HOST)
+DB_READ_PORT = int(os.getenv("DB_READ_PORT", DB_PORT))
+DB_READ_USER = os.getenv("DB_READ_USER", DB_USER)
+DB_READ_PASSWORD = os.getenv("DB_READ_PASSWORD", DB_PASSWORD)
+DB_READ_POOL_MAXSIZE = int(os.getenv("DB_READ_POOL_MAXSIZE", 5))
+
+# Размеры пулов и адаптивный режим (рост maxsize при конкуренции за соединения, сжатие при простое)
+DB_POOL_MINSIZE = int(os.getenv("DB_POOL_MINSIZE", 1))
+DB_POOL_MAXSIZE = int(os.getenv("DB_POOL_MAXSIZE", 10))
+DB_POOL_ADAPTIVE = os.getenv("DB_POOL_ADAPTIVE", "false").lower() in ("1", "true", "yes")
+DB_POOL_ADAPTIVE_MAXSIZE = int(os.getenv("DB_POOL_ADAPTIVE_MAXSIZE", 30))
+DB_READ_POOL_ADAPTIVE_MAXSIZE = int(os.getenv("DB_READ_POOL_ADAPTIVE_MAXSIZE", 15))
+DB_POOL_TUNE_INTERVAL_SECONDS = float(os.getenv("DB_POOL_TUNE_INTERVAL_SECONDS", 10))
+
+# Кэши БД
+BAN_CACHE_REFRESH_SECONDS = int(os.getenv("BAN_CACHE_REFRESH_SECONDS", 60))
+SUBSCRIPTION_CACHE_TTL_SECONDS = int(os.getenv("SUBSCRIPTION_CACHE_TTL_SECONDS", 300))
+SUBSCRIPTION_CACHE_MAX_USERS = int(os.getenv("SUBSCRIPTION_CACHE_MAX_USERS", 100000))
+
+# Отложенная запись профилей пользователей (/start)
+USER_FLUSH_INTERVAL_SECONDS = float(os.getenv("USER_FLUSH_INTERVAL_SECONDS", 5))
+USER_FLUSH_BATCH_SIZE = int(os.getenv("USER_FLUSH_BATCH_SIZE", 500))
+USER_PROFILE_CACHE_MAX_USERS = int(os.getenv("USER_PROFILE_CACHE_MAX_USERS", 200000))
+
 # Платежи
 PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN", "")
 CURRENCY = os.getenv("CURRENCY", "RUB")
+# Уведомления платёжной системы (webhook); без секрета приёмник выключен и работает кнопка «Я оплатил»
+PAYMENT_WEBHOOK_SECRET = os.getenv("PAYMENT_WEBHOOK_SECRET", "")
+PAYMENT_WEBHOOK_HOST = os.getenv("PAYMENT_WEBHOOK_HOST", "0.0.0.0")
+PAYMENT_WEBHOOK_PORT = int(os.getenv("PAYMENT_WEBHOOK_PORT", 8081))
+PAYMENT_WEBHOOK_PATH = os.getenv("PAYMENT_WEBHOOK_PATH", "/payments/webhook")
 
 # VPN Manager (3X-UI)
 VLESS_ADMIN_USERNAME = os.getenv("VLESS_ADMIN_USERNAME", "admin")
 VLESS_ADMIN_PASSWORD = os.getenv("VLESS_ADMIN_PASSWORD", "admin")
 
+# HTTP-клиенты панелей: keep-alive пул соединений на каждую панель
+PANEL_CONNECTION_LIMIT = int(os.getenv("PANEL_CONNECTION_LIMIT", 10))
+PANEL_KEEPALIVE_SECONDS = float(os.getenv("PANEL_KEEPALIVE_SECONDS", 60))
+PANEL_REQUEST_TIMEOUT_SECONDS = float(os.getenv("PANEL_REQUEST_TIMEOUT_SECONDS", 10))
+# Сколько держать cookie сессии панели, если панель не прислала Max-Age
+PANEL_SESSION_TTL_SECONDS = int(os.getenv("PANEL_SESSION_TTL_SECONDS", 3600))
+# Пакетный addClient: окно сбора клиентов и максимальный размер пачки
+PANEL_BATCH_WINDOW_MS = float(os.getenv("PANEL_BATCH_WINDOW_MS", 20))
+PANEL_BATCH_MAX_CLIENTS = int(os.getenv("PANEL_BATCH_MAX_CLIENTS", 50))
+# Резерв заранее созданных клиентов на каждом сервере (0 — выключить)
+WARM_POOL_SIZE_PER_SERVER = int(os.getenv("WARM_POOL_SIZE_PER_SERVER", 10))
+WARM_POOL_REFILL_INTERVAL_SECONDS = float(os.getenv("WARM_POOL_REFILL_INTERVAL_SECONDS", 60))
+# Как часто перечитывать реестр серверов из БД
+SERVER_REGISTRY_REFRESH_SECONDS = float(os.getenv("SERVER_REGISTRY_REFRESH_SECONDS", 60))
+# Порог клиентов на один inbound панели по умолчанию (клиенты inbound'а — один JSON в 3X-UI)
+PANEL_INBOUND_MAX_CLIENTS = int(os.getenv("PANEL_INBOUND_MAX_CLIENTS", 500))
+# Одновременных запросов к одной панели (SQLite внутри 3X-UI всё равно пишет по одному);
+# фоновые запросы, ждущие дольше порога, пропускаются вперёд покупок
+PANEL_MAX_CONCURRENCY = int(os.getenv("PANEL_MAX_CONCURRENCY", 4))
+PANEL_SCHEDULER_AGING_SECONDS = float(os.getenv("PANEL_SCHEDULER_AGING_SECONDS", 10))
+# Проверка здоровья панелей и circuit breaker
+PANEL_PROBE_INTERVAL_SECONDS = float(os.getenv("PANEL_PROBE_INTERVAL_SECONDS", 15))
+PANEL_PROBE_TIMEOUT_SECONDS = float(os.getenv("PANEL_PROBE_TIMEOUT_SECONDS", 5))
+PANEL_CB_FAILURE_THRESHOLD = int(os.getenv("PANEL_CB_FAILURE_THRESHOLD", 3))
+PANEL_CB_OPEN_SECONDS = float(os.getenv("PANEL_CB_OPEN_SECONDS", 30))
+# Создание клиента: сколько серверов пробовать и страхующая попытка на следующем сервере
+PROVISION_MAX_ATTEMPTS = int(os.getenv("PROVISION_MAX_ATTEMPTS", 3))
+PROVISION_HEDGE_ENABLED = os.getenv("PROVISION_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+PROVISION_HEDGE_DELAY_MS = float(os.getenv("PROVISION_HEDGE_DELAY_MS", 1500))
+# Выдача конфига после оплаты: воркеры заданий provisioning_jobs
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", 4))
+PROVISION_JOB_POLL_SECONDS = float(os.getenv("PROVISION_JOB_POLL_SECONDS", 5))
+PROVISION_JOB_MAX_ATTEMPTS = int(os.getenv("PROVISION_JOB_MAX_ATTEMPTS", 8))
+PROVISION_JOB_RETRY_SECONDS = float(os.getenv("PROVISION_JOB_RETRY_SECONDS", 5))
+PROVISION_JOB_LEASE_SECONDS = int(os.getenv("PROVISION_JOB_LEASE_SECONDS", 300))
+# Сбор трафика клиентов с панелей (0 — выключен)
+TRAFFIC_COLLECT_INTERVAL_SECONDS = float(os.getenv("TRAFFIC_COLLECT_INTERVAL_SECONDS", 300))
+TRAFFIC_HOURLY_RETENTION_HOURS = int(os.getenv("TRAFFIC_HOURLY_RETENTION_HOURS", 48))
+TRAFFIC_WRITE_BATCH_SIZE = int(os.getenv("TRAFFIC_WRITE_BATCH_SIZE", 1000))
+# Сверка current_load и клиентов подписок с панелями (0 — только вручную, /reconcile)
+RECONCILE_INTERVAL_SECONDS = float(os.getenv("RECONCILE_INTERVAL_SECONDS", 3600))
+# Расхождение применяется, только если повторный замер через столько секунд дал то же самое
+RECONCILE_CONFIRM_DELAY_SECONDS = float(os.getenv("RECONCILE_CONFIRM_DELAY_SECONDS", 15))
+# Перенос клиентов между серверами (/rebalance)
+REBALANCE_TOLERANCE = float(os.getenv("REBALANCE_TOLERANCE", 0.1))
+REBALANCE_MAX_MOVES = int(os.getenv("REBALANCE_MAX_MOVES", 500))
+REBALANCE_BATCH_SIZE = int(os.getenv("REBALANCE_BATCH_SIZE", 20))
+REBALANCE_BATCH_INTERVAL_SECONDS = float(os.getenv("REBALANCE_BATCH_INTERVAL_SECONDS", 5))
+REBALANCE_PANEL_CONCURRENCY = int(os.getenv("REBALANCE_PANEL_CONCURRENCY", 2))
+# Сколько старый конфиг перенесённого клиента ещё работает после уведомления о переносе
+REBALANCE_GRACE_SECONDS = float(os.getenv("REBALANCE_GRACE_SECONDS", 3600))
+
 # ==================== 3 ТАРИФНЫХ ПЛАНА ====================
 SUBSCRIPTION_PLANS = {
     "standard_1m": {
@@ -0,0 +1,29 @@
+# database/backfill_metrics.py — пересчёт дневной сводки daily_metrics
+#
+# Запуск:
+#   python -m database.backfill_metrics            # вся история
+#   python -m database.backfill_metrics --days 30  # только последние 30 дней
+import argparse
+import asyncio
+import logging
+
+from database.db import init_db, close_db, backfill_daily_metrics
+
+logger = logging.getLogger(__name__)
+
+
+async def main(days: int | None):
+    await init_db()
+    try:
+        await backfill_daily_metrics(days)
+        logger.info("✅ daily_metrics пересчитана" + (f" за {days} дн." if days else " за всю историю"))
+    finally:
+        await close_db()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Пересчёт таблицы daily_metrics из users/payments/subscriptions")
+    parser.add_argument("--days", type=int, default=None, help="пересчитать только последние N дней")
+    args = parser.parse_args()
+    asyncio.run(main(args.days))
@@ -1,93 +1,113 @@
 # database/db.py — ИСПРАВЛЕННАЯ ВЕРСИЯ
+import asyncio
+import time
 import aiomysql
-from config import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME
-from typing import Optional, List, Dict, Any
+from contextlib import asynccontextmanager
+from database.migrations import run_migrations
+from database.pool_metrics import InstrumentedPool
+from config import (
+    DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME,
+    DB_READ_HOST, DB_READ_PORT, DB_READ_USER, DB_READ_PASSWORD, DB_READ_POOL_MAXSIZE,
+    DB_POOL_MINSIZE, DB_POOL_MAXSIZE, DB_POOL_ADAPTIVE, DB_POOL_ADAPTIVE_MAXSIZE,
+    DB_READ_POOL_ADAPTIVE_MAXSIZE, DB_POOL_TUNE_INTERVAL_SECONDS,
+    BAN_CACHE_REFRESH_SECONDS, SUBSCRIPTION_CACHE_TTL_SECONDS, SUBSCRIPTION_CACHE_MAX_USERS,
+    USER_FLUSH_INTERVAL_SECONDS, USER_FLUSH_BATCH_SIZE, USER_PROFILE_CACHE_MAX_USERS
+)
+from typing import Optional, List, Dict, Any, Set, Tuple, AsyncIterator
 from datetime import datetime, timedelta, date
 import logging
 
 logger = logging.getLogger(__name__)
 pool = None
+# Пул для отчётов и списков (может смотреть на реплику). Чтения после записи
+# (create_subscription, платежи) остаются на основном pool.
+read_pool = None
+
+# Фоновые задачи модуля (обновление кэшей и т.п.), гасятся в close_db()
+_background_tasks: List[asyncio.Task] = []
+
+# Кэш заблокированных пользователей — middleware проверяет бан без запроса к БД
+_banned_users: Set[int] = set()
+# Баны/разбаны, сделанные во время идущих refresh_banned_users(): user_id -> забанен ли.
+# Снимок из БД мог быть сделан до них — после подмены множества они применяются поверх
+_ban_changes_during_refresh: List[Dict[int, bool]] = []
+
+# Кэш активных подписок: user_id -> (строка подписки или None, момент истечения по time.monotonic())
+_subscription_cache: Dict[int, Tuple[Optional[Dict], float]] = {}
+# Счётчик инвалидаций: не кладём в кэш результат запроса, который обогнала запись
+_subscription_cache_generation = 0
+
+# Write-behind для профилей: хэш последнего записанного профиля и ожидающие записи
+_user_profile_hashes: Dict[int, int] = {}
+_pending_user_profiles: Dict[int, Tuple[Optional[str], Optional[str], Optional[str]]] = {}
 
 async def init_db():
-    global pool
-    pool = await aiomysql.create_pool(
-        host=DB_HOST,
-        port=DB_PORT,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        db=DB_NAME,
-        charset='utf8mb4',
-        autocommit=True,
+    global pool, read_pool
+    pool = InstrumentedPool(
+        await aiomysql.create_pool(
+            host=DB_HOST,
+            port=DB_PORT,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            db=DB_NAME,
+            charset='utf8mb4',
+            autocommit=True,
+            minsize=DB_POOL_MINSIZE,
+            maxsize=max(DB_POOL_MAXSIZE, DB_POOL_ADAPTIVE_MAXSIZE if DB_POOL_ADAPTIVE else 0)
+        ),
+        name="primary",
+        minsize=DB_POOL_MINSIZE,
+        maxsize=DB_POOL_MAXSIZE,
+        adaptive_maxsize=DB_POOL_ADAPTIVE_MAXSIZE if DB_POOL_ADAPTIVE else None
+    )
+    # Отдельный пул, чтобы тяжёлая аналитика админки не забирала соединения у оплаты
+    read_pool = InstrumentedPool(
+        await aiomysql.create_pool(
+            host=DB_READ_HOST,
+            port=DB_READ_PORT,
+            user=DB_READ_USER,
+            password=DB_READ_PASSWORD,
+            db=DB_NAME,
+            charset='utf8mb4',
+            autocommit=True,
+            minsize=1,
+            maxsize=max(DB_READ_POOL_MAXSIZE, DB_READ_POOL_ADAPTIVE_MAXSIZE if DB_POOL_ADAPTIVE else 0)
+        ),
+        name="read",
         minsize=1,
-        maxsize=10
+        maxsize=DB_READ_POOL_MAXSIZE,
+        adaptive_maxsize=DB_READ_POOL_ADAPTIVE_MAXSIZE if DB_POOL_ADAPTIVE else None
     )
+    if DB_POOL_ADAPTIVE:
+        _background_tasks.append(asyncio.create_task(pool.autoscale(DB_POOL_TUNE_INTERVAL_SECONDS)))
+        _background_tasks.append(asyncio.create_task(read_pool.autoscale(DB_POOL_TUNE_INTERVAL_SECONDS)))
 
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    username VARCHAR(255),
-                    first_name VARCHAR(255),
-                    last_name VARCHAR(255),
-                    registration_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    is_banned BOOLEAN DEFAULT FALSE
-                )
-            ''')
-
-            await cur.execute('''
-                CREATE TABLE IF NOT EXISTS subscriptions (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT,
-                    plan_type VARCHAR(100),
-                    start_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    end_date DATETIME NOT NULL,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    vpn_config TEXT,
-                    vpn_login VARCHAR(100),
-                    vpn_password VARCHAR(100),
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-                )
-            ''')
-
-            await cur.execute('''
-                CREATE TABLE IF NOT EXISTS payments (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT,
-                    amount DECIMAL(10,2),
-                    currency VARCHAR(10) DEFAULT 'RUB',
-                    plan_type VARCHAR(100),
-                    status VARCHAR(50) DEFAULT 'pending',
-                    payment_id VARCHAR(255) UNIQUE,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            ''')
+    await run_migrations(pool)
 
-            await cur.execute('''
-                CREATE TABLE IF NOT EXISTS vless_servers (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    name VARCHAR(100) NOT NULL,
-                    ip VARCHAR(45) NOT NULL,
-                    port INT NOT NULL,
-                    secret_path VARCHAR(100) NOT NULL,
-                    pbk VARCHAR(44) NOT NULL,
-                    sid VARCHAR(16),
-                    type ENUM('standard', 'bypass') DEFAULT 'standard',
-                    is_active BOOLEAN DEFAULT TRUE,
-                    current_load INT DEFAULT 0,
-                    max_clients INT DEFAULT 1000,
-                    remark VARCHAR(255),
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+    await refresh_banned_users()
+    _background_tasks.append(asyncio.create_task(_banned_users_refresher()))
+    _background_tasks.append(asyncio.create_task(_user_profiles_flusher()))
 
 async def close_db():
     global pool
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
     if pool:
+        try:
+            await flush_user_profiles()
+        except Exception as e:
+            logger.error(f"Не удалось сбросить профили пользователей при остановке: {e}")
         pool.close()
         await pool.wait_closed()
+    if read_pool:
+        read_pool.close()
+        await read_pool.wait_closed()
+
+def get_pool_metrics() -> Dict[str, Dict[str, Any]]:
+    """Метрики пулов: ожидание acquire, занятые/свободные соединения, задержки и ошибки по запросам"""
+    return {p.name: p.snapshot() for p in (pool, read_pool) if p}
 
 # ========== ПОЛЬЗОВАТЕЛИ ==========
 async def get_user(user_id: int) -> Optional[Dict]:
@@ -96,37 +116,153 @@ async def get_user(user_id: int) -> Optional[Dict]:
             await cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
             return await cur.fetchone()
 
+_UPSERT_USER_SQL = '''
+    INSERT INTO users (user_id, username, first_name, last_name)
+    VALUES (%s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        username=VALUES(username),
+        first_name=VALUES(first_name),
+        last_name=VALUES(last_name)
+'''
+
+def _remember_user_profile(user_id: int, profile_hash: int):
+    if user_id not in _user_profile_hashes and len(_user_profile_hashes) >= USER_PROFILE_CACHE_MAX_USERS:
+        _user_profile_hashes.pop(next(iter(_user_profile_hashes)))
+    _user_profile_hashes[user_id] = profile_hash
+
 async def create_user(user_id: int, username=None, first_name=None, last_name=None):
+    profile = (username, first_name, last_name)
+    profile_hash = hash(profile)
+    known_hash = _user_profile_hashes.get(user_id)
+
+    # Профиль не менялся — повторный /start ничего не пишет
+    if known_hash == profile_hash:
+        return
+
+    # Уже записанный пользователь сменил имя — откладываем запись до ближайшего сброса
+    if known_hash is not None:
+        _pending_user_profiles[user_id] = profile
+        _remember_user_profile(user_id, profile_hash)
+        return
+
+    # Неизвестный процессу пользователь пишется сразу: на него ссылаются FK подписок и платежей
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
-            await cur.execute('''
-                INSERT INTO users (user_id, username, first_name, last_name)
-                VALUES (%s, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE
-                    username=VALUES(username),
-                    first_name=VALUES(first_name),
-                    last_name=VALUES(last_name)
-            ''', (user_id, username, first_name, last_name))
+            await cur.execute(_UPSERT_USER_SQL, (user_id, username, first_name, last_name))
+            # ON DUPLICATE KEY UPDATE: 1 — новая строка, 2 — обновление, 0 — без изменений
+            if cur.rowcount == 1:
+                await cur.execute('''
+                    INSERT INTO daily_metrics (day, new_users) VALUES (CURDATE(), 1)
+                    ON DUPLICATE KEY UPDATE new_users = new_users + 1
+                ''')
+    _pending_user_profiles.pop(user_id, None)
+    _remember_user_profile(user_id, profile_hash)
+
+async def flush_user_profiles():
+    """Записать накопленные изменения профилей пачками через executemany"""
+    while _pending_user_profiles:
+        batch = []
+        for user_id in list(_pending_user_profiles)[:USER_FLUSH_BATCH_SIZE]:
+            batch.append((user_id, *_pending_user_profiles.pop(user_id)))
+        try:
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.executemany(_UPSERT_USER_SQL, batch)
+        except Exception:
+            # Возвращаем пачку в буфер, не затирая более свежие изменения
+            for user_id, *profile in batch:
+                _pending_user_profiles.setdefault(user_id, tuple(profile))
+            raise
+
+async def _user_profiles_flusher():
+    """Периодический сброс буфера профилей"""
+    while True:
+        await asyncio.sleep(USER_FLUSH_INTERVAL_SECONDS)
+        try:
+            await flush_user_profiles()
+        except Exception as e:
+            logger.error(f"Не удалось сбросить профили пользователей: {e}")
 
 async def is_user_banned(user_id: int) -> bool:
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute("SELECT is_banned FROM users WHERE user_id = %s", (user_id,))
-            result = await cur.fetchone()
-            return bool(result[0]) if result else False
+    """Проверка бана по in-memory кэшу (без обращения к БД)"""
+    return user_id in _banned_users
+
+async def refresh_banned_users():
+    """Перечитать список заблокированных из таблицы users"""
+    global _banned_users
+    changes: Dict[int, bool] = {}
+    _ban_changes_during_refresh.append(changes)
+    try:
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT user_id FROM users WHERE is_banned = TRUE")
+                rows = await cur.fetchall()
+    finally:
+        _ban_changes_during_refresh.remove(changes)
+    banned = {row[0] for row in rows}
+    for user_id, is_banned in changes.items():
+        if is_banned:
+            banned.add(user_id)
+        else:
+            banned.discard(user_id)
+    # Подменяем множество целиком, чтобы читатели не видели его в промежуточном состоянии
+    _banned_users = banned
+
+def _record_ban_change(user_id: int, is_banned: bool):
+    for changes in _ban_changes_during_refresh:
+        changes[user_id] = is_banned
+
+async def _banned_users_refresher():
+    """Периодическая синхронизация кэша банов между процессами бота"""
+    while True:
+        await asyncio.sleep(BAN_CACHE_REFRESH_SECONDS)
+        try:
+            await refresh_banned_users()
+        except Exception as e:
+            logger.error(f"Не удалось обновить кэш банов: {e}")
 
 async def ban_user(user_id: int):
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
             await cur.execute("UPDATE users SET is_banned = TRUE WHERE user_id = %s", (user_id,))
+    _banned_users.add(user_id)
+    _record_ban_change(user_id, True)
 
 async def unban_user(user_id: int):
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
             await cur.execute("UPDATE users SET is_banned = FALSE WHERE user_id = %s", (user_id,))
+    _banned_users.discard(user_id)
+    _record_ban_change(user_id, False)
 
 # ========== ПОДПИСКИ ==========
+def invalidate_subscription_cache(user_id: int):
+    """Сбросить закэшированную подписку пользователя"""
+    global _subscription_cache_generation
+    _subscription_cache_generation += 1
+    _subscription_cache.pop(user_id, None)
+
+def _cache_subscription(user_id: int, subscription: Optional[Dict]):
+    ttl = SUBSCRIPTION_CACHE_TTL_SECONDS
+    if subscription:
+        # Подписка не должна пережить в кэше свой end_date
+        ttl = min(ttl, (subscription['end_date'] - datetime.now()).total_seconds())
+    if ttl <= 0:
+        return
+    if user_id not in _subscription_cache and len(_subscription_cache) >= SUBSCRIPTION_CACHE_MAX_USERS:
+        # Вытесняем самую старую запись (dict хранит порядок вставки)
+        _subscription_cache.pop(next(iter(_subscription_cache)))
+    _subscription_cache[user_id] = (subscription, time.monotonic() + ttl)
+
 async def get_active_subscription(user_id: int) -> Optional[Dict]:
+    cached = _subscription_cache.get(user_id)
+    if cached:
+        subscription, expires_at = cached
+        if time.monotonic() < expires_at:
+            return subscription
+        del _subscription_cache[user_id]
+
+    generation = _subscription_cache_generation
     async with pool.acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
             await cur.execute('''
@@ -134,36 +270,122 @@ async def get_active_subscription(user_id: int) -> Optional[Dict]:
                 WHERE user_id = %s AND is_active = TRUE AND end_date > NOW()
                 ORDER BY end_date DESC LIMIT 1
             ''', (user_id,))
-            return await cur.fetchone()
+            subscription = await cur.fetchone()
+
+    # Кэшируем и отсутствие подписки — меню без подписки тоже не ходит в БД
+    if generation == _subscription_cache_generation:
+        _cache_subscription(user_id, subscription)
+    return subscription
 
 async def create_subscription(user_id: int, plan_type: str, duration_days: int, vpn_config: str,
-                            vpn_login: str = None, vpn_password: str = None) -> Dict:
-    end_date = datetime.now() + timedelta(days=duration_days)
+                            vpn_login: str = None, vpn_password: str = None, server_id: int = None,
+                            inbound_id: int = None, client_uuid: str = None, job_id: int = None) -> Dict:
+    """Атомарно заменить активную подписку новой
+
+    Всё в одной транзакции; возвращаемая строка собирается из вставленных значений
+    и lastrowid, без повторного SELECT (который мог вернуть чужую параллельную вставку).
+    job_id — задание provisioning_jobs, которое получает ссылку на подписку в той же транзакции.
+    """
+    # DATETIME без долей секунды — обрезаем, чтобы строка совпадала с тем, что лежит в БД
+    now = datetime.now().replace(microsecond=0)
+    end_date = now + timedelta(days=duration_days)
     async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute("UPDATE subscriptions SET is_active = FALSE WHERE user_id = %s AND is_active = TRUE", (user_id,))
-            await cur.execute('''
-                INSERT INTO subscriptions 
-                (user_id, plan_type, end_date, vpn_config, vpn_login, vpn_password)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (user_id, plan_type, end_date, vpn_config, vpn_login, vpn_password))
-            await cur.execute("SELECT * FROM subscriptions WHERE user_id = %s ORDER BY id DESC LIMIT 1", (user_id,))
-            return await cur.fetchone()
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute("UPDATE subscriptions SET is_active = FALSE WHERE user_id = %s AND is_active = TRUE", (user_id,))
+                await cur.execute('''
+                    INSERT INTO subscriptions 
+                    (user_id, plan_type, start_date, end_date, is_active, vpn_config, vpn_login, vpn_password,
+                     server_id, inbound_id, client_uuid, created_at)
+                    VALUES (%s, %s, %s, %s, TRUE, %s, %s, %s, %s, %s, %s, %s)
+                ''', (user_id, plan_type, now, end_date, vpn_config, vpn_login, vpn_password,
+                      server_id, inbound_id, client_uuid, now))
+                subscription_id = cur.lastrowid
+                if job_id is not None:
+                    await cur.execute(
+                        "UPDATE provisioning_jobs SET subscription_id = %s WHERE id = %s",
+                        (subscription_id, job_id)
+                    )
+                await cur.execute('''
+                    INSERT INTO daily_metrics (day, subscriptions_created) VALUES (CURDATE(), 1)
+                    ON DUPLICATE KEY UPDATE subscriptions_created = subscriptions_created + 1
+                ''')
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+    subscription = {
+        "id": subscription_id,
+        "user_id": user_id,
+        "plan_type": plan_type,
+        "start_date": now,
+        "end_date": end_date,
+        "is_active": 1,
+        "vpn_config": vpn_config,
+        "vpn_login": vpn_login,
+        "vpn_password": vpn_password,
+        "server_id": server_id,
+        "inbound_id": inbound_id,
+        "client_uuid": client_uuid,
+        "created_at": now,
+    }
+    # Сразу кладём новую подписку в кэш — следующий экран меню не пойдёт в БД
+    invalidate_subscription_cache(user_id)
+    _cache_subscription(user_id, subscription)
+    return subscription
 
 # ========== ПЛАТЕЖИ ==========
-async def create_payment(user_id: int, amount: float, currency: str, plan_type: str, payment_id: str):
+async def create_payment(user_id: int, amount: float, currency: str, plan_type: str, payment_id: str,
+                         plan_id: str = None):
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
             await cur.execute('''
                 INSERT IGNORE INTO payments 
-                (user_id, amount, currency, plan_type, payment_id, status)
-                VALUES (%s, %s, %s, %s, %s, 'pending')
-            ''', (user_id, amount, currency, plan_type, payment_id))
+                (user_id, amount, currency, plan_type, plan_id, payment_id, status)
+                VALUES (%s, %s, %s, %s, %s, %s, 'pending')
+            ''', (user_id, amount, currency, plan_type, plan_id, payment_id))
+
+async def update_payment_status(payment_id: str, status: str, job: Optional[Dict] = None) -> bool:
+    """Сменить статус платежа; True — статус действительно изменился
 
-async def update_payment_status(payment_id: str, status: str):
+    job — задание на выдачу конфига (user_id, plan_type, duration_days, server_type):
+    ставится в очередь той же транзакцией, что и переход в новый статус.
+    """
     async with pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute("UPDATE payments SET status = %s WHERE payment_id = %s", (status, payment_id))
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE payments SET status = %s WHERE payment_id = %s AND status <> %s",
+                    (status, payment_id, status)
+                )
+                changed = cur.rowcount > 0
+                # В дневную сводку платёж попадает один раз — при фактическом переходе в succeeded
+                if status == 'succeeded' and cur.rowcount:
+                    await cur.execute('''
+                        INSERT INTO daily_metrics (day, payments_count, revenue)
+                        SELECT DATE(created_at), 1, amount FROM payments WHERE payment_id = %s
+                        ON DUPLICATE KEY UPDATE
+                            payments_count = payments_count + 1,
+                            revenue = revenue + VALUES(revenue)
+                    ''', (payment_id,))
+                # Задание — тоже только при переходе: платёж, уже оплаченный раньше (в том числе выданный
+                # старым синхронным путём без задания), второго клиента не получит
+                if job is not None and changed:
+                    # INSERT IGNORE по UNIQUE payment_id — страховка от гонки двух подтверждений
+                    await cur.execute('''
+                        INSERT IGNORE INTO provisioning_jobs
+                        (payment_id, user_id, plan_type, duration_days, server_type)
+                        VALUES (%s, %s, %s, %s, %s)
+                    ''', (payment_id, job['user_id'], job['plan_type'], job['duration_days'],
+                          job.get('server_type', 'standard')))
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+    return changed
 
 async def get_payment_by_id(payment_id: str) -> Optional[Dict]:
     async with pool.acquire() as conn:
@@ -172,7 +394,7 @@ async def get_payment_by_id(payment_id: str) -> Optional[Dict]:
             return await cur.fetchone()
 
 async def get_user_payments(user_id: int) -> List[Dict]:
-    async with pool.acquire() as conn:
+    async with read_pool.acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
             await cur.execute("""
                 SELECT * FROM payments 
@@ -183,34 +405,23 @@ async def get_user_payments(user_id: int) -> List[Dict]:
             return await cur.fetchall()
 
 # ========== СТАТИСТИКА (ИСПРАВЛЕНО!) ==========
+# Админка читает дневную сводку daily_metrics (O(дней)), а не сканирует payments/users
 async def get_stats() -> Dict[str, Any]:
-    async with pool.acquire() as conn:
+    async with read_pool.acquire() as conn:
         async with conn.cursor() as cur:
-            # Правильный способ получения значений
-            await cur.execute("SELECT COUNT(*) FROM users")
-            total_users = (await cur.fetchone())[0]
+            await cur.execute("SELECT COALESCE(SUM(new_users), 0), COALESCE(SUM(revenue), 0) FROM daily_metrics")
+            total_users, total_revenue = await cur.fetchone()
             
             await cur.execute("SELECT COUNT(*) FROM subscriptions WHERE is_active = TRUE AND end_date > NOW()")
             active_subs = (await cur.fetchone())[0]
             
-            await cur.execute("SELECT COALESCE(SUM(amount), 0) FROM payments WHERE status = 'succeeded'")
-            total_revenue = (await cur.fetchone())[0]
-            
-            today = date.today()
-            await cur.execute('''
-                SELECT COALESCE(SUM(amount), 0) FROM payments 
-                WHERE status = 'succeeded' AND DATE(created_at) = %s
-            ''', (today,))
-            revenue_today = (await cur.fetchone())[0]
-            
-            await cur.execute("SELECT COUNT(*) FROM users WHERE DATE(registration_date) = %s", (today,))
-            new_today = (await cur.fetchone())[0]
-            
-            await cur.execute("SELECT COUNT(*) FROM payments WHERE status='succeeded' AND DATE(created_at)=%s", (today,))
-            payments_today = (await cur.fetchone())[0]
+            await cur.execute(
+                "SELECT new_users, revenue, payments_count FROM daily_metrics WHERE day = CURDATE()"
+            )
+            new_today, revenue_today, payments_today = await cur.fetchone() or (0, 0, 0)
 
             return {
-                "total_users": total_users or 0,
+                "total_users": int(total_users or 0),
                 "active_subscriptions": active_subs or 0,
                 "total_revenue": float(total_revenue or 0),
                 "revenue_today": float(revenue_today or 0),
@@ -219,17 +430,45 @@ async def get_stats() -> Dict[str, Any]:
             }
 
 async def get_revenue_by_period(days: int) -> List[Dict]:
-    async with pool.acquire() as conn:
+    async with read_pool.acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
             await cur.execute('''
-                SELECT DATE(created_at) as date, COALESCE(SUM(amount), 0) as total, COUNT(*) as count
-                FROM payments
-                WHERE status = 'succeeded' AND created_at >= DATE_SUB(CURDATE(), INTERVAL %s DAY)
-                GROUP BY DATE(created_at)
-                ORDER BY date DESC
+                SELECT day as date, revenue as total, payments_count as count
+                FROM daily_metrics
+                WHERE day >= DATE_SUB(CURDATE(), INTERVAL %s DAY) AND payments_count > 0
+                ORDER BY day DESC
             ''', (days,))
             return await cur.fetchall()
 
+async def backfill_daily_metrics(days: Optional[int] = None):
+    """Пересчитать daily_metrics из исходных таблиц (всю историю или последние days дней)"""
+    since = date.today() - timedelta(days=days) if days else date(1970, 1, 1)
+    async with pool.acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute("DELETE FROM daily_metrics WHERE day >= %s", (since,))
+                await cur.execute('''
+                    INSERT INTO daily_metrics (day, new_users, payments_count, revenue, subscriptions_created)
+                    SELECT day, SUM(new_users), SUM(payments_count), SUM(revenue), SUM(subscriptions_created) FROM (
+                        SELECT DATE(registration_date) AS day, COUNT(*) AS new_users, 0 AS payments_count,
+                               0 AS revenue, 0 AS subscriptions_created
+                        FROM users WHERE registration_date >= %s GROUP BY DATE(registration_date)
+                        UNION ALL
+                        SELECT DATE(created_at), 0, COUNT(*), SUM(amount), 0
+                        FROM payments WHERE status = 'succeeded' AND created_at >= %s GROUP BY DATE(created_at)
+                        UNION ALL
+                        SELECT DATE(created_at), 0, 0, 0, COUNT(*)
+                        FROM subscriptions WHERE created_at >= %s GROUP BY DATE(created_at)
+                    ) AS history
+                    WHERE day IS NOT NULL
+                    GROUP BY day
+                ''', (since, since, since))
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
 # ========== VLESS СЕРВЕРА ==========
 async def get_active_servers(server_type: str = None) -> List[Dict]:
     async with pool.acquire() as conn:
@@ -240,20 +479,473 @@ async def get_active_servers(server_type: str = None) -> List[Dict]:
                 await cur.execute("SELECT * FROM vless_servers WHERE is_active = TRUE ORDER BY current_load ASC")
             return await cur.fetchall()
 
+async def get_all_servers() -> List[Dict]:
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute("SELECT * FROM vless_servers")
+            return await cur.fetchall()
+
 async def get_server_by_id(server_id: int) -> Optional[Dict]:
     async with pool.acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
             await cur.execute("SELECT * FROM vless_servers WHERE id = %s", (server_id,))
             return await cur.fetchone()
 
-async def add_vless_server(name: str, ip: str, port: int, secret: str, pbk: str, sid: str | None, server_type: str, max_clients: int = 1000) -> int:
+async def get_all_inbounds() -> List[Dict]:
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute("SELECT * FROM vless_inbounds ORDER BY server_id, inbound_id")
+            return await cur.fetchall()
+
+async def reserve_server_capacity(server_id: int, inbound_id: int, count: int = 1) -> bool:
+    """Атомарно занять count мест на сервере и в его inbound, не превышая ни один из max_clients"""
     async with pool.acquire() as conn:
         async with conn.cursor() as cur:
-            await cur.execute("""
-                INSERT INTO vless_servers (name, ip, port, secret_path, pbk, sid, type, max_clients)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (name, ip, port, secret, pbk, sid, server_type, max_clients))
-            return cur.lastrowid
+            # Один многотабличный UPDATE: либо обновятся обе строки, либо ни одной
+            await cur.execute('''
+                UPDATE vless_servers s JOIN vless_inbounds i ON i.server_id = s.id
+                SET s.current_load = s.current_load + %s, i.current_load = i.current_load + %s
+                WHERE s.id = %s AND i.inbound_id = %s AND s.is_active = TRUE AND i.is_active = TRUE
+                  AND s.current_load + %s <= s.max_clients AND i.current_load + %s <= i.max_clients
+            ''', (count, count, server_id, inbound_id, count, count))
+            return cur.rowcount > 0
+
+async def release_server_capacity(server_id: int, inbound_id: int, count: int = 1):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute('''
+                UPDATE vless_servers s JOIN vless_inbounds i ON i.server_id = s.id
+                SET s.current_load = GREATEST(s.current_load - %s, 0),
+                    i.current_load = GREATEST(i.current_load - %s, 0)
+                WHERE s.id = %s AND i.inbound_id = %s
+            ''', (count, count, server_id, inbound_id))
+
+async def add_vless_server(name: str, ip: str, port: int, secret: str, pbk: str, sid: str | None, server_type: str,
+                           max_clients: int = 1000, inbounds: List[Tuple[int, Optional[int]]] = None,
+                           inbound_max_clients: int = 500) -> int:
+    """Добавить сервер вместе с его inbound'ами — [(inbound_id, порт или None)], по умолчанию только inbound 1"""
+    async with pool.acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute("""
+                    INSERT INTO vless_servers (name, ip, port, secret_path, pbk, sid, type, max_clients)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                """, (name, ip, port, secret, pbk, sid, server_type, max_clients))
+                server_id = cur.lastrowid
+                await cur.executemany(
+                    "INSERT INTO vless_inbounds (server_id, inbound_id, port, max_clients) VALUES (%s, %s, %s, %s)",
+                    [(server_id, inbound_id, inbound_port, inbound_max_clients)
+                     for inbound_id, inbound_port in inbounds or [(1, None)]]
+                )
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+    return server_id
+
+async def get_inbound_loads() -> Dict[Tuple[int, int], int]:
+    """current_load всех inbound'ов: (server_id, inbound_id) -> клиентов по счётчику"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT server_id, inbound_id, current_load FROM vless_inbounds")
+            return {(server_id, inbound_id): load for server_id, inbound_id, load in await cur.fetchall()}
+
+async def apply_load_corrections(corrections: List[Tuple[int, int, int]]):
+    """Поправить счётчики inbound'ов на delta по (server_id, inbound_id, delta) — по одному UPDATE на таблицу
+
+    Применяется разница, а не абсолютное значение: резервирования, прошедшие
+    после снятия данных, не затираются.
+    """
+    if not corrections:
+        return
+    derived = " UNION ALL ".join(["SELECT %s AS server_id, %s AS inbound_id, %s AS delta"] * len(corrections))
+    params = [value for correction in corrections for value in correction]
+    async with pool.acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(f'''
+                    UPDATE vless_inbounds i
+                    JOIN ({derived}) AS fix ON fix.server_id = i.server_id AND fix.inbound_id = i.inbound_id
+                    SET i.current_load = GREATEST(i.current_load + fix.delta, 0)
+                ''', params)
+                # Загрузка сервера — сумма его inbound'ов (и заодно чинит расхождение между ними)
+                server_ids = sorted({server_id for server_id, _, _ in corrections})
+                await cur.execute(f'''
+                    UPDATE vless_servers s
+                    JOIN (
+                        SELECT server_id, SUM(current_load) AS load_sum FROM vless_inbounds
+                        WHERE server_id IN ({", ".join(["%s"] * len(server_ids))})
+                        GROUP BY server_id
+                    ) AS actual ON actual.server_id = s.id
+                    SET s.current_load = actual.load_sum
+                ''', server_ids)
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+async def get_expected_clients() -> List[Dict]:
+    """Клиенты, которые должны быть на панелях: активные подписки и резерв
+
+    source — 'subscription' или 'pool'; server_id у старых подписок может быть NULL.
+    """
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute('''
+                SELECT 'subscription' AS source, id, user_id, vpn_login AS email, server_id, inbound_id
+                FROM subscriptions WHERE is_active = TRUE AND vpn_login IS NOT NULL
+                UNION ALL
+                SELECT 'pool', id, NULL, email, server_id, inbound_id
+                FROM vless_client_pool WHERE claimed_at IS NULL
+            ''')
+            return await cur.fetchall()
+
+# ========== РЕЗЕРВ VLESS КЛИЕНТОВ ==========
+async def claim_pooled_client(server_type: str, server_ids: List[int]) -> Optional[Dict]:
+    """Атомарно забрать готового клиента из резерва (None — резерв пуст)
+
+    server_ids — серверы, с которых можно брать (панель которых сейчас доступна).
+    """
+    if not server_ids:
+        return None
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            # LAST_INSERT_ID(id) отдаёт id забранной строки через lastrowid — без SELECT ... FOR UPDATE
+            await cur.execute(f'''
+                UPDATE vless_client_pool
+                SET claimed_at = NOW(), id = LAST_INSERT_ID(id)
+                WHERE server_type = %s AND claimed_at IS NULL
+                  AND server_id IN ({', '.join(['%s'] * len(server_ids))})
+                  AND server_id IN (SELECT id FROM vless_servers WHERE is_active = TRUE)
+                ORDER BY id
+                LIMIT 1
+            ''', (server_type, *server_ids))
+            if not cur.rowcount:
+                return None
+            await cur.execute('''
+                SELECT p.*, s.name AS server_name FROM vless_client_pool p
+                JOIN vless_servers s ON s.id = p.server_id
+                WHERE p.id = %s
+            ''', (cur.lastrowid,))
+            return await cur.fetchone()
+
+async def add_pooled_clients(clients: List[Dict]):
+    """Положить в резерв клиентов, уже созданных на панели"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany('''
+                INSERT INTO vless_client_pool (server_id, inbound_id, server_type, client_uuid, email, vpn_config)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            ''', [
+                (c['server_id'], c['inbound_id'], c['server_type'], c['uuid'], c['email'], c['config'])
+                for c in clients
+            ])
+
+async def count_pooled_clients() -> Dict[int, int]:
+    """Количество свободных клиентов в резерве по server_id"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute('''
+                SELECT server_id, COUNT(*) FROM vless_client_pool
+                WHERE claimed_at IS NULL GROUP BY server_id
+            ''')
+            return {server_id: count for server_id, count in await cur.fetchall()}
+
+async def purge_claimed_pooled_clients(older_than_hours: int = 24):
+    """Удалить давно забранные строки резерва (клиент уже живёт в subscriptions)"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "DELETE FROM vless_client_pool WHERE claimed_at < NOW() - INTERVAL %s HOUR",
+                (older_than_hours,)
+            )
+
+# ========== ПЕРЕНОС КЛИЕНТОВ ==========
+async def get_movable_subscriptions(server_id: int, limit: int) -> List[Dict]:
+    """Действующие подписки сервера, которые можно перенести (и которые ещё не переносятся)"""
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute('''
+                SELECT s.id, s.user_id, s.server_id, s.inbound_id, s.client_uuid FROM subscriptions s
+                WHERE s.server_id = %s AND s.is_active = TRUE AND s.end_date > NOW()
+                  AND s.client_uuid IS NOT NULL
+                  AND NOT EXISTS (
+                      SELECT 1 FROM rebalance_moves m
+                      WHERE m.subscription_id = s.id AND m.status NOT IN ('done', 'failed')
+                  )
+                ORDER BY s.id
+                LIMIT %s
+            ''', (server_id, limit))
+            return await cur.fetchall()
+
+async def create_rebalance_run(server_type: str, moves: List[Dict]) -> int:
+    """Записать план переноса целиком — с этого момента его можно продолжить после перезапуска"""
+    async with pool.acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute("INSERT INTO rebalance_runs (server_type) VALUES (%s)", (server_type,))
+                run_id = cur.lastrowid
+                await cur.executemany('''
+                    INSERT INTO rebalance_moves
+                    (run_id, subscription_id, user_id, from_server_id, from_inbound_id, old_uuid, to_server_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ''', [
+                    (run_id, m['subscription_id'], m['user_id'], m['from_server_id'],
+                     m['from_inbound_id'], m['old_uuid'], m['to_server_id'])
+                    for m in moves
+                ])
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+    return run_id
+
+async def get_unfinished_rebalance_runs() -> List[Dict]:
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute("SELECT * FROM rebalance_runs WHERE status = 'running' ORDER BY id")
+            return await cur.fetchall()
+
+async def get_rebalance_moves(run_id: int, statuses: Optional[List[str]] = None) -> List[Dict]:
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            if statuses:
+                await cur.execute(
+                    f"SELECT * FROM rebalance_moves WHERE run_id = %s AND status IN ({', '.join(['%s'] * len(statuses))}) ORDER BY id",
+                    (run_id, *statuses)
+                )
+            else:
+                await cur.execute("SELECT * FROM rebalance_moves WHERE run_id = %s ORDER BY id", (run_id,))
+            return await cur.fetchall()
+
+async def update_rebalance_move(move_id: int, **fields):
+    """Сохранить шаг перемещения (имена полей — только из кода, не от пользователя)"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                f"UPDATE rebalance_moves SET {', '.join(f'{name} = %s' for name in fields)} WHERE id = %s",
+                (*fields.values(), move_id)
+            )
+
+async def switch_subscription_client(move: Dict) -> bool:
+    """Перевести подписку на нового клиента и отметить перемещение одной транзакцией
+
+    False — подписка за время переноса перестала быть активной (её клиент больше не нужен).
+    """
+    async with pool.acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute('''
+                    UPDATE subscriptions
+                    SET vpn_config = %s, vpn_login = %s, vpn_password = %s,
+                        server_id = %s, inbound_id = %s, client_uuid = %s
+                    WHERE id = %s AND is_active = TRUE AND client_uuid = %s
+                ''', (move['vpn_config'], move['new_email'], move['new_uuid'][:16],
+                      move['to_server_id'], move['to_inbound_id'], move['new_uuid'],
+                      move['subscription_id'], move['old_uuid']))
+                switched = cur.rowcount == 1
+                await cur.execute(
+                    "UPDATE rebalance_moves SET status = %s, error = %s WHERE id = %s",
+                    ('switched', None, move['id']) if switched else ('failed', 'subscription changed', move['id'])
+                )
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+    invalidate_subscription_cache(move['user_id'])
+    return switched
+
+@asynccontextmanager
+async def rebalance_run_lock(run_id: int):
+    """GET_LOCK на перенос: один перенос ведёт один процесс бота (yield — удалось ли взять)
+
+    Блокировка живёт в соединении MySQL, поэтому оно занято на всё время блока.
+    """
+    name = f"rebalance_run_{run_id}"
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT GET_LOCK(%s, 0)", (name,))
+            (acquired,) = await cur.fetchone()
+            try:
+                yield acquired == 1
+            finally:
+                if acquired == 1:
+                    await cur.execute("SELECT RELEASE_LOCK(%s)", (name,))
+
+async def finish_rebalance_run(run_id: int, status: str = 'done'):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "UPDATE rebalance_runs SET status = %s, finished_at = NOW() WHERE id = %s",
+                (status, run_id)
+            )
+
+# ========== ЗАДАНИЯ ВЫДАЧИ ==========
+async def claim_provisioning_job(lease_seconds: int) -> Optional[Dict]:
+    """Атомарно взять задание в работу (None — брать нечего)
+
+    Берутся задания, чей срок повтора наступил, и «running» с истёкшей арендой —
+    их воркер упал или бот перезапустили посреди выдачи.
+    """
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute('''
+                UPDATE provisioning_jobs
+                SET status = 'running', attempts = attempts + 1,
+                    locked_until = NOW() + INTERVAL %s SECOND, id = LAST_INSERT_ID(id)
+                WHERE (status = 'queued' AND next_attempt_at <= NOW())
+                   OR (status = 'running' AND locked_until < NOW())
+                ORDER BY next_attempt_at, id
+                LIMIT 1
+            ''', (lease_seconds,))
+            if not cur.rowcount:
+                return None
+            await cur.execute("SELECT * FROM provisioning_jobs WHERE id = %s", (cur.lastrowid,))
+            return await cur.fetchone()
+
+async def save_provisioning_client(job_id: int, vless: Dict):
+    """Запомнить созданного на панели клиента — повтор задания не создаст второго"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute('''
+                UPDATE provisioning_jobs
+                SET client_uuid = %s, client_email = %s, server_id = %s, inbound_id = %s, vpn_config = %s
+                WHERE id = %s
+            ''', (vless['uuid'], vless['email'], vless['server_id'], vless['inbound_id'],
+                  vless['config'], job_id))
+
+async def complete_provisioning_job(job_id: int):
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "UPDATE provisioning_jobs SET status = 'done', locked_until = NULL, error = NULL WHERE id = %s",
+                (job_id,)
+            )
+
+async def fail_provisioning_job(job_id: int, error: str, retry_in: Optional[float] = None):
+    """Вернуть задание в очередь через retry_in секунд; без retry_in — окончательный отказ"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            if retry_in is None:
+                await cur.execute(
+                    "UPDATE provisioning_jobs SET status = 'failed', locked_until = NULL, error = %s WHERE id = %s",
+                    (error[:255], job_id)
+                )
+            else:
+                await cur.execute('''
+                    UPDATE provisioning_jobs
+                    SET status = 'queued', locked_until = NULL, error = %s,
+                        next_attempt_at = NOW() + INTERVAL %s SECOND
+                    WHERE id = %s
+                ''', (error[:255], int(retry_in), job_id))
+
+async def count_provisioning_jobs() -> Dict[str, int]:
+    """Количество заданий по статусам (для /dbstats)"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT status, COUNT(*) FROM provisioning_jobs GROUP BY status")
+            return {status: count for status, count in await cur.fetchall()}
+
+# ========== ТРАФИК КЛИЕНТОВ ==========
+async def get_traffic_counters(server_id: int) -> Dict[str, Tuple[int, int]]:
+    """Последние сохранённые счётчики (up, down) клиентов сервера по email"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT email, up, down FROM client_traffic_counters WHERE server_id = %s",
+                (server_id,)
+            )
+            return {email: (up, down) for email, up, down in await cur.fetchall()}
+
+async def save_traffic_samples(server_id: int, ts: datetime,
+                               counters: List[Tuple[str, int, int]],
+                               deltas: List[Tuple[str, int, int]],
+                               batch_size: int = 1000):
+    """Записать новые счётчики и приращения одного цикла сбора одной транзакцией
+
+    counters и deltas — (email, up, down); executemany сворачивает каждую пачку
+    в один многострочный INSERT.
+    """
+    async with pool.acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                for i in range(0, len(counters), batch_size):
+                    await cur.executemany('''
+                        INSERT INTO client_traffic_counters (server_id, email, up, down, updated_at)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE up = VALUES(up), down = VALUES(down), updated_at = VALUES(updated_at)
+                    ''', [(server_id, email, up, down, ts) for email, up, down in counters[i:i + batch_size]])
+                for i in range(0, len(deltas), batch_size):
+                    await cur.executemany('''
+                        INSERT INTO client_traffic_raw (email, ts, server_id, up, down)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE up = up + VALUES(up), down = down + VALUES(down)
+                    ''', [(email, ts, server_id, up, down) for email, up, down in deltas[i:i + batch_size]])
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+async def rollup_traffic(hourly_retention_hours: int):
+    """Даунсэмплинг: завершённые часы raw → hourly, сутки старше hourly_retention_hours → daily"""
+    now = datetime.now()
+    hour_cutoff = now.replace(minute=0, second=0, microsecond=0)
+    day_cutoff = datetime.combine((now - timedelta(hours=hourly_retention_hours)).date(), datetime.min.time())
+
+    async with pool.acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                # Перенос и удаление по одной границе в одной транзакции — точки не считаются дважды
+                await cur.execute('''
+                    INSERT INTO client_traffic_hourly (email, hour, server_id, up, down)
+                    SELECT email, DATE_FORMAT(ts, '%%Y-%%m-%%d %%H:00:00') AS hour, server_id, SUM(up), SUM(down)
+                    FROM client_traffic_raw WHERE ts < %s
+                    GROUP BY email, hour, server_id
+                    ON DUPLICATE KEY UPDATE up = up + VALUES(up), down = down + VALUES(down)
+                ''', (hour_cutoff,))
+                await cur.execute("DELETE FROM client_traffic_raw WHERE ts < %s", (hour_cutoff,))
+
+                await cur.execute('''
+                    INSERT INTO client_traffic_daily (email, day, server_id, up, down)
+                    SELECT email, DATE(hour) AS day, server_id, SUM(up), SUM(down)
+                    FROM client_traffic_hourly WHERE hour < %s
+                    GROUP BY email, day, server_id
+                    ON DUPLICATE KEY UPDATE up = up + VALUES(up), down = down + VALUES(down)
+                ''', (day_cutoff,))
+                await cur.execute("DELETE FROM client_traffic_hourly WHERE hour < %s", (day_cutoff,))
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+async def get_client_traffic(email: str, since: datetime) -> Dict[str, Any]:
+    """Трафик клиента начиная с since по всем уровням агрегации (старый хвост — с точностью до суток)"""
+    async with read_pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute('''
+                SELECT COALESCE(SUM(up), 0) AS up,
+                       COALESCE(SUM(down), 0) AS down,
+                       COALESCE(SUM(CASE WHEN ts >= NOW() - INTERVAL 1 DAY THEN up + down END), 0) AS last_day,
+                       COUNT(DISTINCT server_id) AS servers,
+                       MAX(ts) AS last_seen
+                FROM (
+                    SELECT day AS ts, server_id, up, down FROM client_traffic_daily
+                    WHERE email = %s AND day >= DATE(%s)
+                    UNION ALL
+                    SELECT hour, server_id, up, down FROM client_traffic_hourly
+                    WHERE email = %s AND hour >= %s
+                    UNION ALL
+                    SELECT ts, server_id, up, down FROM client_traffic_raw
+                    WHERE email = %s AND ts >= %s
+                ) AS traffic
+            ''', (email, since, email, since, email, since))
+            return await cur.fetchone()
 
 # ========== ДОПОЛНИТЕЛЬНЫЕ ФУНКЦИИ ==========
 async def get_user_subscriptions(user_id: int):
@@ -267,22 +959,110 @@ async def get_user_subscriptions(user_id: int):
             return await cur.fetchall()
 
 async def get_all_users():
-    async with pool.acquire() as conn:
+    async with read_pool.acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
             await cur.execute("SELECT * FROM users WHERE NOT is_banned ORDER BY registration_date DESC")
             return await cur.fetchall()
 
-async def search_users(query: str):
-    query = f"%{query.strip()}%"
-    async with pool.acquire() as conn:
+async def iter_users(active_only: bool = False, page_size: int = 1000) -> AsyncIterator[Dict]:
+    """Потоковый обход незаблокированных пользователей страницами по user_id (keyset)
+
+    Соединение держится только на время чтения страницы, поэтому медленный
+    потребитель (рассылка) не занимает пул, а память не зависит от размера таблицы.
+    """
+    active_filter = '''
+        AND EXISTS (
+            SELECT 1 FROM subscriptions s
+            WHERE s.user_id = users.user_id AND s.is_active = TRUE AND s.end_date > NOW()
+        )
+    ''' if active_only else ""
+    last_user_id = -1
+    while True:
+        async with read_pool.acquire() as conn:
+            # SSDictCursor — небуферизованный курсор, строки не копятся целиком на клиенте
+            async with conn.cursor(aiomysql.SSDictCursor) as cur:
+                await cur.execute(f"""
+                    SELECT * FROM users
+                    WHERE user_id > %s AND NOT is_banned {active_filter}
+                    ORDER BY user_id
+                    LIMIT %s
+                """, (last_user_id, page_size))
+                page = await cur.fetchall()
+        if not page:
+            return
+        for user in page:
+            yield user
+        if len(page) < page_size:
+            return
+        last_user_id = page[-1]['user_id']
+
+async def count_users(include_banned: bool = False) -> int:
+    async with read_pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            if include_banned:
+                await cur.execute("SELECT COUNT(*) FROM users")
+            else:
+                await cur.execute("SELECT COUNT(*) FROM users WHERE NOT is_banned")
+            return (await cur.fetchone())[0]
+
+async def count_users_with_active_subscription() -> int:
+    async with read_pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute('''
+                SELECT COUNT(DISTINCT s.user_id) FROM subscriptions s
+                JOIN users u ON u.user_id = s.user_id
+                WHERE s.is_active = TRUE AND s.end_date > NOW() AND NOT u.is_banned
+            ''')
+            return (await cur.fetchone())[0]
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+async def search_users(query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+    """Поиск пользователей для админки с ранжированием и пагинацией
+
+    - число — точный поиск по user_id (первичный ключ);
+    - @username — точное совпадение, затем префикс по индексу username;
+    - остальное — FULLTEXT (ngram) по username/имени/фамилии, по убыванию релевантности.
+    """
+    query = query.strip()
+    if not query:
+        return []
+
+    async with read_pool.acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
+            if query.isdigit():
+                if offset:
+                    return []
+                await cur.execute("SELECT * FROM users WHERE user_id = %s", (int(query),))
+                return await cur.fetchall()
+
+            if query.startswith("@"):
+                username = query[1:]
+                await cur.execute("""
+                    SELECT * FROM users
+                    WHERE username LIKE %s
+                    ORDER BY username = %s DESC, username
+                    LIMIT %s OFFSET %s
+                """, (_escape_like(username) + "%", username, limit, offset))
+                return await cur.fetchall()
+
+            # ngram-токены короче двух символов в индекс не попадают — для них только префикс username
+            if len(query) < 2:
+                await cur.execute("""
+                    SELECT * FROM users WHERE username LIKE %s
+                    ORDER BY username
+                    LIMIT %s OFFSET %s
+                """, (_escape_like(query) + "%", limit, offset))
+                return await cur.fetchall()
+
+            # Фраза в BOOLEAN MODE с ngram-парсером ~ подстрочное совпадение
+            phrase = '"' + query.replace('"', ' ') + '"'
             await cur.execute("""
-                SELECT * FROM users 
-                WHERE CAST(user_id AS CHAR) LIKE %s 
-                   OR username LIKE %s 
-                   OR first_name LIKE %s 
-                   OR last_name LIKE %s
-                ORDER BY registration_date DESC
-                LIMIT 20
-            """, (query, query, query, query))
-            return await cur.fetchall()
\ No newline at end of file
+                SELECT *, MATCH(username, first_name, last_name) AGAINST (%s IN BOOLEAN MODE) AS score
+                FROM users
+                WHERE MATCH(username, first_name, last_name) AGAINST (%s IN BOOLEAN MODE)
+                ORDER BY score DESC, registration_date DESC
+                LIMIT %s OFFSET %s
+            """, (phrase, phrase, limit, offset))
+            return await cur.fetchall()
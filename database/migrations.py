@@ -0,0 +1,323 @@
+# database/migrations.py — версионные миграции схемы
+import aiomysql
+import logging
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# MySQL: индекс / колонка уже существует (миграция была прервана посередине)
+ER_DUP_FIELDNAME = 1060
+ER_DUP_KEYNAME = 1061
+
+# (версия, название, список DDL). Уже применённые версии не трогаем —
+# новые изменения схемы добавляем только новой записью в конец списка.
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "initial_schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            first_name VARCHAR(255),
+            last_name VARCHAR(255),
+            registration_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            is_banned BOOLEAN DEFAULT FALSE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT,
+            plan_type VARCHAR(100),
+            start_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            end_date DATETIME NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE,
+            vpn_config TEXT,
+            vpn_login VARCHAR(100),
+            vpn_password VARCHAR(100),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT,
+            amount DECIMAL(10,2),
+            currency VARCHAR(10) DEFAULT 'RUB',
+            plan_type VARCHAR(100),
+            status VARCHAR(50) DEFAULT 'pending',
+            payment_id VARCHAR(255) UNIQUE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS vless_servers (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            ip VARCHAR(45) NOT NULL,
+            port INT NOT NULL,
+            secret_path VARCHAR(100) NOT NULL,
+            pbk VARCHAR(44) NOT NULL,
+            sid VARCHAR(16),
+            type ENUM('standard', 'bypass') DEFAULT 'standard',
+            is_active BOOLEAN DEFAULT TRUE,
+            current_load INT DEFAULT 0,
+            max_clients INT DEFAULT 1000,
+            remark VARCHAR(255),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, "hot_query_indexes", [
+        # get_active_subscription: WHERE user_id AND is_active AND end_date > NOW() ORDER BY end_date
+        "CREATE INDEX idx_subscriptions_user_active_end ON subscriptions (user_id, is_active, end_date)",
+        # get_stats: количество активных подписок
+        "CREATE INDEX idx_subscriptions_active_end ON subscriptions (is_active, end_date)",
+        # get_stats / get_revenue_by_period: покрывающий индекс, SUM(amount) без чтения строк
+        "CREATE INDEX idx_payments_status_created ON payments (status, created_at, amount)",
+        # get_stats: новые пользователи за день
+        "CREATE INDEX idx_users_registration_date ON users (registration_date)",
+        # get_active_servers: WHERE is_active AND type ORDER BY current_load
+        "CREATE INDEX idx_vless_servers_active_type_load ON vless_servers (is_active, type, current_load)",
+    ]),
+    (3, "daily_metrics_rollup", [
+        # Дневные агрегаты для админки — обновляются инкрементально из database/db.py
+        '''
+        CREATE TABLE IF NOT EXISTS daily_metrics (
+            day DATE PRIMARY KEY,
+            new_users INT NOT NULL DEFAULT 0,
+            payments_count INT NOT NULL DEFAULT 0,
+            revenue DECIMAL(12,2) NOT NULL DEFAULT 0,
+            subscriptions_created INT NOT NULL DEFAULT 0
+        )
+        ''',
+        # Первичное заполнение историей (повторно — python -m database.backfill_metrics)
+        '''
+        INSERT INTO daily_metrics (day, new_users, payments_count, revenue, subscriptions_created)
+        SELECT day, SUM(new_users), SUM(payments_count), SUM(revenue), SUM(subscriptions_created) FROM (
+            SELECT DATE(registration_date) AS day, COUNT(*) AS new_users, 0 AS payments_count,
+                   0 AS revenue, 0 AS subscriptions_created
+            FROM users GROUP BY DATE(registration_date)
+            UNION ALL
+            SELECT DATE(created_at), 0, COUNT(*), SUM(amount), 0
+            FROM payments WHERE status = 'succeeded' GROUP BY DATE(created_at)
+            UNION ALL
+            SELECT DATE(created_at), 0, 0, 0, COUNT(*)
+            FROM subscriptions GROUP BY DATE(created_at)
+        ) AS history
+        WHERE day IS NOT NULL
+        GROUP BY day
+        ON DUPLICATE KEY UPDATE
+            new_users = VALUES(new_users),
+            payments_count = VALUES(payments_count),
+            revenue = VALUES(revenue),
+            subscriptions_created = VALUES(subscriptions_created)
+        ''',
+    ]),
+    (4, "users_search_indexes", [
+        # search_users: точное совпадение и префикс по @username
+        "CREATE INDEX idx_users_username ON users (username)",
+        # search_users: подстрочный поиск по имени — FULLTEXT с ngram-парсером вместо LIKE '%q%'
+        "CREATE FULLTEXT INDEX ft_users_names ON users (username, first_name, last_name) WITH PARSER ngram",
+    ]),
+    (5, "vless_client_pool", [
+        # Резерв заранее созданных на панелях клиентов: оплата забирает готового одним UPDATE
+        '''
+        CREATE TABLE IF NOT EXISTS vless_client_pool (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            server_id INT NOT NULL,
+            server_type ENUM('standard', 'bypass') NOT NULL,
+            client_uuid VARCHAR(36) NOT NULL,
+            email VARCHAR(100) NOT NULL,
+            vpn_config TEXT NOT NULL,
+            claimed_at DATETIME NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_client_pool_unclaimed (server_type, claimed_at, id),
+            INDEX idx_client_pool_server (server_id, claimed_at),
+            FOREIGN KEY (server_id) REFERENCES vless_servers(id) ON DELETE CASCADE
+        )
+        ''',
+    ]),
+    (6, "client_traffic_timeseries", [
+        # Последние увиденные счётчики up/down каждого клиента — из них считаются приращения
+        '''
+        CREATE TABLE IF NOT EXISTS client_traffic_counters (
+            server_id INT NOT NULL,
+            email VARCHAR(100) NOT NULL,
+            up BIGINT UNSIGNED NOT NULL DEFAULT 0,
+            down BIGINT UNSIGNED NOT NULL DEFAULT 0,
+            updated_at DATETIME NOT NULL,
+            PRIMARY KEY (server_id, email)
+        )
+        ''',
+        # Приращения за цикл сбора; завершённые часы сворачиваются в client_traffic_hourly
+        '''
+        CREATE TABLE IF NOT EXISTS client_traffic_raw (
+            email VARCHAR(100) NOT NULL,
+            ts DATETIME NOT NULL,
+            server_id INT NOT NULL,
+            up BIGINT UNSIGNED NOT NULL,
+            down BIGINT UNSIGNED NOT NULL,
+            PRIMARY KEY (email, ts, server_id),
+            INDEX idx_client_traffic_raw_ts (ts)
+        )
+        ''',
+        # Почасовые суммы; старше TRAFFIC_HOURLY_RETENTION_HOURS сворачиваются в client_traffic_daily
+        '''
+        CREATE TABLE IF NOT EXISTS client_traffic_hourly (
+            email VARCHAR(100) NOT NULL,
+            hour DATETIME NOT NULL,
+            server_id INT NOT NULL,
+            up BIGINT UNSIGNED NOT NULL,
+            down BIGINT UNSIGNED NOT NULL,
+            PRIMARY KEY (email, hour, server_id),
+            INDEX idx_client_traffic_hourly_hour (hour)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS client_traffic_daily (
+            email VARCHAR(100) NOT NULL,
+            day DATE NOT NULL,
+            server_id INT NOT NULL,
+            up BIGINT UNSIGNED NOT NULL,
+            down BIGINT UNSIGNED NOT NULL,
+            PRIMARY KEY (email, day, server_id)
+        )
+        ''',
+    ]),
+    (7, "vless_inbounds", [
+        # Несколько inbound'ов на панели: клиенты inbound'а лежат одним JSON, и чем он больше,
+        # тем дороже каждый addClient/delClient — поэтому клиентов раскладываем по inbound'ам
+        '''
+        CREATE TABLE IF NOT EXISTS vless_inbounds (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            server_id INT NOT NULL,
+            inbound_id INT NOT NULL,
+            port INT NULL,
+            is_active BOOLEAN DEFAULT TRUE,
+            current_load INT DEFAULT 0,
+            max_clients INT DEFAULT 500,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_vless_inbounds_server_inbound (server_id, inbound_id),
+            FOREIGN KEY (server_id) REFERENCES vless_servers(id) ON DELETE CASCADE
+        )
+        ''',
+        # Существующие серверы работали через inbound 1 — переносим их загрузку туда как есть
+        '''
+        INSERT IGNORE INTO vless_inbounds (server_id, inbound_id, current_load, max_clients)
+        SELECT id, 1, current_load, max_clients FROM vless_servers
+        ''',
+        # Где живёт клиент подписки — чтобы удалять его из нужного inbound нужной панели
+        "ALTER TABLE subscriptions ADD COLUMN server_id INT NULL, ADD COLUMN inbound_id INT NULL, "
+        "ADD COLUMN client_uuid VARCHAR(36) NULL",
+        "ALTER TABLE vless_client_pool ADD COLUMN inbound_id INT NOT NULL DEFAULT 1 AFTER server_id",
+    ]),
+    (8, "rebalance_moves", [
+        # Перенос клиентов между серверами: каждое перемещение — строка с состоянием,
+        # чтобы после падения бота продолжить с того же шага
+        '''
+        CREATE TABLE IF NOT EXISTS rebalance_runs (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            server_type ENUM('standard', 'bypass') NOT NULL,
+            status ENUM('running', 'done', 'cancelled') NOT NULL DEFAULT 'running',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS rebalance_moves (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            run_id INT NOT NULL,
+            subscription_id INT NOT NULL,
+            user_id BIGINT NOT NULL,
+            from_server_id INT NOT NULL,
+            from_inbound_id INT NULL,
+            old_uuid VARCHAR(36) NOT NULL,
+            to_server_id INT NOT NULL,
+            to_inbound_id INT NULL,
+            new_uuid VARCHAR(36) NULL,
+            new_email VARCHAR(100) NULL,
+            vpn_config TEXT NULL,
+            status ENUM('pending', 'creating', 'created', 'switched', 'done', 'failed')
+                NOT NULL DEFAULT 'pending',
+            error VARCHAR(255) NULL,
+            notified_at DATETIME NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            INDEX idx_rebalance_moves_run_status (run_id, status),
+            INDEX idx_rebalance_moves_subscription (subscription_id),
+            FOREIGN KEY (run_id) REFERENCES rebalance_runs(id) ON DELETE CASCADE
+        )
+        ''',
+    ]),
+    (9, "provisioning_jobs", [
+        # Выдача конфига после оплаты: обработчик только ставит задание, воркеры
+        # (utils/provisioning.py) создают клиента и отправляют конфиг с повторами
+        '''
+        CREATE TABLE IF NOT EXISTS provisioning_jobs (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            payment_id VARCHAR(255) NOT NULL UNIQUE,
+            user_id BIGINT NOT NULL,
+            plan_type VARCHAR(100) NOT NULL,
+            duration_days INT NOT NULL,
+            server_type ENUM('standard', 'bypass') NOT NULL DEFAULT 'standard',
+            status ENUM('queued', 'running', 'done', 'failed') NOT NULL DEFAULT 'queued',
+            attempts INT NOT NULL DEFAULT 0,
+            next_attempt_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            locked_until DATETIME NULL,
+            client_uuid VARCHAR(36) NULL,
+            client_email VARCHAR(100) NULL,
+            server_id INT NULL,
+            inbound_id INT NULL,
+            vpn_config TEXT NULL,
+            subscription_id INT NULL,
+            error VARCHAR(255) NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            INDEX idx_provisioning_jobs_status (status, next_attempt_at),
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+    ]),
+    (10, "payments_plan_id", [
+        # Тариф платежа по ключу SUBSCRIPTION_PLANS: уведомление платёжной системы приходит
+        # без FSM-состояния, а по plan_type (названию) тарифы разной длительности не различить
+        "ALTER TABLE payments ADD COLUMN plan_id VARCHAR(50) NULL AFTER plan_type",
+    ]),
+]
+
+
+async def run_migrations(pool):
+    """Применить недостающие миграции (уже применённые пропускаются)"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            # Несколько процессов бота не должны мигрировать схему одновременно
+            await cur.execute("SELECT GET_LOCK('schema_migrations', 60)")
+            try:
+                await cur.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INT PRIMARY KEY,
+                        name VARCHAR(255) NOT NULL,
+                        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                await cur.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in await cur.fetchall()}
+
+                for version, name, statements in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    logger.info(f"🛠 Применяю миграцию {version}: {name}")
+                    for statement in statements:
+                        try:
+                            await cur.execute(statement)
+                        except aiomysql.MySQLError as e:
+                            # DDL в MySQL не транзакционен: после сбоя часть индексов и колонок уже может быть создана
+                            if e.args[0] not in (ER_DUP_FIELDNAME, ER_DUP_KEYNAME):
+                                raise
+                    await cur.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                        (version, name)
+                    )
+            finally:
+                await cur.execute("SELECT RELEASE_LOCK('schema_migrations')")
@@ -0,0 +1,196 @@
+# database/pool_metrics.py — инструментированный пул соединений MySQL
+import asyncio
+import bisect
+import logging
+import sys
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы, мс
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Ожидание acquire() дольше этого порога считается конкуренцией за пул
+CONTENTION_THRESHOLD_MS = 5
+# Доля «конкурентных» acquire() в окне, при которой пул растёт
+CONTENTION_RATIO_TO_GROW = 0.1
+# Сколько подряд спокойных окон нужно, чтобы ужать пул на одно соединение
+IDLE_WINDOWS_TO_SHRINK = 3
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными корзинами"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает q-квантиль"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_ms, 2),
+        }
+
+
+class InstrumentedPool:
+    """Обёртка над aiomysql-пулом: метрики acquire/запросов и адаптивный maxsize
+
+    Нижележащий пул создаётся с потолком adaptive_maxsize, а фактический лимит
+    одновременно выданных соединений регулируется здесь — так размер можно менять
+    на лету, не трогая внутренности aiomysql.
+    """
+
+    def __init__(self, pool, name: str, minsize: int, maxsize: int, adaptive_maxsize: Optional[int] = None):
+        self._pool = pool
+        self.name = name
+        self.minsize = minsize
+        self.base_maxsize = maxsize
+        self.ceiling = max(adaptive_maxsize or maxsize, maxsize)
+        self._limit = maxsize
+        self._in_use = 0
+        self._waiters = 0
+        self._cond = asyncio.Condition()
+
+        self.acquire_wait = LatencyHistogram()
+        self.query_latency: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+        # Счётчики текущего окна адаптивного режима
+        self._window_acquires = 0
+        self._window_contended = 0
+        self._window_peak_in_use = 0
+        self._idle_windows = 0
+
+    @property
+    def maxsize(self) -> int:
+        return self._limit
+
+    def acquire(self, query_name: Optional[str] = None):
+        """async with pool.acquire() as conn — имя запроса по умолчанию берётся из вызывающей функции"""
+        if query_name is None:
+            query_name = sys._getframe(1).f_code.co_name
+        return self._acquire(query_name)
+
+    @asynccontextmanager
+    async def _acquire(self, query_name: str):
+        started = time.perf_counter()
+        async with self._cond:
+            self._waiters += 1
+            try:
+                await self._cond.wait_for(lambda: self._in_use < self._limit)
+            finally:
+                self._waiters -= 1
+            self._in_use += 1
+            self._window_peak_in_use = max(self._window_peak_in_use, self._in_use)
+
+        try:
+            conn = await self._pool.acquire()
+        except BaseException:
+            self.errors[query_name] += 1
+            await self._release_slot()
+            raise
+
+        waited_ms = (time.perf_counter() - started) * 1000
+        self.acquire_wait.observe(waited_ms)
+        self._window_acquires += 1
+        if waited_ms > CONTENTION_THRESHOLD_MS:
+            self._window_contended += 1
+
+        query_started = time.perf_counter()
+        try:
+            yield conn
+        except Exception:
+            self.errors[query_name] += 1
+            raise
+        finally:
+            self.query_latency[query_name].observe((time.perf_counter() - query_started) * 1000)
+            try:
+                await self._pool.release(conn)
+            finally:
+                # Отмена или ошибка возврата соединения не должна уносить слот лимита
+                await self._release_slot()
+
+    async def _release_slot(self):
+        async with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "maxsize": self._limit,
+            "ceiling": self.ceiling,
+            "in_use": self._in_use,
+            "idle": self._pool.freesize,
+            "waiting": self._waiters,
+            "acquire_wait": self.acquire_wait.snapshot(),
+            "queries": {name: h.snapshot() for name, h in self.query_latency.items()},
+            "errors": dict(self.errors),
+        }
+
+    async def tune(self):
+        """Один шаг адаптивного режима: рост при конкуренции, сжатие при простое"""
+        acquires, contended = self._window_acquires, self._window_contended
+        peak = self._window_peak_in_use
+        self._window_acquires = self._window_contended = 0
+        self._window_peak_in_use = self._in_use
+
+        contention = contended / acquires if acquires else 0.0
+        if (self._waiters or contention >= CONTENTION_RATIO_TO_GROW) and self._limit < self.ceiling:
+            old = self._limit
+            self._limit = min(self.ceiling, self._limit + max(1, self._limit // 4))
+            self._idle_windows = 0
+            logger.info(f"📈 Пул {self.name}: maxsize {old} → {self._limit} (конкуренция {contention:.0%})")
+            async with self._cond:
+                self._cond.notify_all()
+        elif peak <= self._limit // 2 and self._limit > self.base_maxsize:
+            self._idle_windows += 1
+            if self._idle_windows >= IDLE_WINDOWS_TO_SHRINK:
+                old = self._limit
+                self._limit -= 1
+                self._idle_windows = 0
+                # Закрываем простаивающие соединения — нужные откроются заново по требованию
+                await self._pool.clear()
+                logger.info(f"📉 Пул {self.name}: maxsize {old} → {self._limit}")
+        else:
+            self._idle_windows = 0
+
+    async def autoscale(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.tune()
+            except Exception as e:
+                logger.error(f"Ошибка адаптации пула {self.name}: {e}")
+
+    def close(self):
+        self._pool.close()
+
+    async def wait_closed(self):
+        await self._pool.wait_closed()
@@ -20,6 +20,12 @@ from database.db import (
     get_user_payments,
     get_active_servers,
     add_vless_server,
+    iter_users,
+    count_users,
+    count_users_with_active_subscription,
+    search_users,
+    get_pool_metrics,
+    count_provisioning_jobs,
 )
 
 # Добавляем недостающие функции ПРЯМО ЗДЕСЬ (чтобы не падало)
@@ -36,42 +42,30 @@ async def get_user_subscriptions(user_id: int):
             """, (user_id,))
             return await cur.fetchall()
 
-async def get_all_users():
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute("SELECT * FROM users WHERE NOT is_banned ORDER BY registration_date DESC")
-            return await cur.fetchall()
-
-async def search_users(query: str):
-    query = f"%{query.strip()}%"
-    async with pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute("""
-                SELECT * FROM users 
-                WHERE user_id LIKE %s 
-                   OR username LIKE %s 
-                   OR first_name LIKE %s 
-                   OR last_name LIKE %s
-                ORDER BY registration_date DESC
-                LIMIT 20
-            """, (query, query, query, query))
-            return await cur.fetchall()
-
 # Теперь импортируем клавиатуры
 from keyboards.keyboard import (
     get_admin_menu, get_stats_keyboard, get_users_management_keyboard,
     get_user_actions_keyboard, get_give_subscription_keyboard,
     get_broadcast_confirm_keyboard, get_broadcast_type_keyboard,
     get_finance_keyboard, get_back_keyboard, get_confirm_keyboard,
-    get_vless_servers_keyboard
+    get_vless_servers_keyboard, get_search_results_keyboard
 )
 
-from config import ADMIN_IDS, SUBSCRIPTION_PLANS
+from utils.server_registry import load_servers, get_inbounds
+from utils.panel_health import get_panel_health
+from utils.panel_scheduler import get_scheduler_metrics
+from utils.reconciler import reconcile, get_last_report
+from utils.rebalancer import plan_rebalance, summarize_plan, start_rebalance, resume_rebalance
+from utils.server_registry import get_server
+from config import ADMIN_IDS, SUBSCRIPTION_PLANS, PANEL_INBOUND_MAX_CLIENTS
 import logging
 
 router = Router()
 logger = logging.getLogger(__name__)
 
+SEARCH_PAGE_SIZE = 10
+
+
 class AdminStates(StatesGroup):
     waiting_broadcast_message = State()
     waiting_user_search = State()
@@ -221,6 +215,148 @@ async def refresh_stats(callback: CallbackQuery):
     await callback.answer("✅ Обновлено")
 
 
+@router.message(Command('dbstats'))
+async def cmd_db_stats(message: Message):
+    """Метрики пулов соединений MySQL"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    text = "🗄 <b>Пулы соединений MySQL</b>\n\n"
+    for name, m in get_pool_metrics().items():
+        wait = m['acquire_wait']
+        text += (
+            f"<b>{name}</b>: занято {m['in_use']}/{m['maxsize']} "
+            f"(свободно {m['idle']}, ждут {m['waiting']}, потолок {m['ceiling']})\n"
+            f"├ Ожидание acquire: p50 {wait['p50_ms']:.0f} / p95 {wait['p95_ms']:.0f} / "
+            f"p99 {wait['p99_ms']:.0f} мс ({wait['count']} шт.)\n"
+        )
+        # Самые медленные запросы по p95
+        slowest = sorted(m['queries'].items(), key=lambda q: q[1]['p95_ms'], reverse=True)[:5]
+        for query_name, q in slowest:
+            errors = m['errors'].get(query_name, 0)
+            text += f"├ {query_name}: p95 {q['p95_ms']:.0f} мс, {q['count']} шт., ошибок {errors}\n"
+        text += "\n"
+    
+    await message.answer(text, parse_mode='HTML')
+
+
+@router.message(Command('reconcile'))
+async def cmd_reconcile(message: Message):
+    """Сверка current_load и подписок с клиентами панелей (/reconcile last — последний отчёт)"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    if message.text.split()[1:] == ['last']:
+        report = get_last_report()
+        if report is None:
+            await message.answer("Сверка ещё не запускалась")
+            return
+    else:
+        await message.answer("⏳ Сверяю панели...")
+        report = await reconcile()
+    
+    text = (
+        "🧮 <b>Сверка с панелями</b>\n"
+        f"{report['checked_at'].strftime('%d.%m.%Y %H:%M')}\n\n"
+        f"Панелей проверено: {report['servers_checked']}\n"
+    )
+    if report['servers_failed']:
+        text += f"Без ответа: {', '.join(report['servers_failed'])}\n"
+    if report['inbounds_skipped']:
+        text += f"Пропущено inbound'ов (менялись во время сверки): {report['inbounds_skipped']}\n"
+    
+    text += f"\n<b>Исправлено счётчиков: {len(report['corrections'])}</b>\n"
+    for server_name, inbound_id, delta in report['corrections'][:10]:
+        text += f"├ {server_name} #{inbound_id}: {delta:+d}\n"
+    if report['corrections_unconfirmed']:
+        text += f"Не подтвердилось повторным замером: {report['corrections_unconfirmed']}\n"
+    
+    text += f"\n<b>Клиенты без подписки: {len(report['orphans'])}</b>\n"
+    for server_name, inbound_id, email in report['orphans'][:10]:
+        text += f"├ {server_name} #{inbound_id}: <code>{email}</code>\n"
+    
+    text += f"\n<b>Подписки без клиента на панели: {len(report['missing'])}</b>\n"
+    for row in report['missing'][:10]:
+        text += f"├ <code>{row['user_id']}</code> — {row['email']} ({row['server_name']})\n"
+    if report['missing_pooled']:
+        text += f"\nПропавших клиентов резерва: {report['missing_pooled']}\n"
+    
+    await message.answer(text, parse_mode='HTML')
+
+
+@router.message(Command('rebalance'))
+async def cmd_rebalance(message: Message):
+    """Перенос клиентов: /rebalance [standard|bypass] — план, /rebalance run — выполнить, /rebalance resume"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    args = message.text.split()[1:]
+    server_type = "bypass" if "bypass" in args else "standard"
+    
+    if "resume" in args:
+        run_ids = await resume_rebalance(message.bot)
+        await message.answer(
+            f"🔀 Продолжаю переносы: {', '.join(f'#{run_id}' for run_id in run_ids)}" if run_ids
+            else "Незавершённых переносов нет"
+        )
+        return
+    
+    if "run" in args:
+        run_id = await start_rebalance(message.bot, server_type)
+        await message.answer(
+            f"🔀 Перенос #{run_id} запущен. Пользователи получат новые конфиги автоматически."
+            if run_id else "Серверы загружены равномерно — переносить нечего"
+        )
+        return
+    
+    moves = await plan_rebalance(server_type)
+    if not moves:
+        await message.answer("Серверы загружены равномерно — переносить нечего")
+        return
+    
+    text = f"🔀 <b>План переноса ({server_type})</b>\n\nКлиентов: {len(moves)}\n\n"
+    for (from_id, to_id), count in sorted(summarize_plan(moves).items()):
+        from_server, to_server = get_server(from_id), get_server(to_id)
+        text += f"├ {from_server['name'] if from_server else from_id} → {to_server['name'] if to_server else to_id}: {count}\n"
+    text += f"\nВыполнить: <code>/rebalance {server_type} run</code>"
+    await message.answer(text, parse_mode='HTML')
+
+
+@router.message(Command('panelstats'))
+async def cmd_panel_stats(message: Message):
+    """Очереди выдачи конфигов и запросов к панелям: глубина, ожидание слота по приоритетам"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    jobs = await count_provisioning_jobs()
+    text = (
+        f"📦 <b>Выдача конфигов</b>: в очереди {jobs.get('queued', 0)}, "
+        f"в работе {jobs.get('running', 0)}, с ошибкой {jobs.get('failed', 0)}\n\n"
+    )
+    
+    metrics = get_scheduler_metrics()
+    if not metrics:
+        await message.answer(text + "К панелям ещё не было запросов", parse_mode='HTML')
+        return
+    
+    text += "📡 <b>Очереди запросов к панелям</b>\n\n"
+    for server_id, m in sorted(metrics.items()):
+        server = get_server(server_id)
+        text += (
+            f"<b>{server['name'] if server else server_id}</b>: выполняется {m['active']}/{m['limit']}, "
+            f"в очереди {sum(m['queued'].values())} (макс. {m['max_depth']})\n"
+        )
+        for name, wait in m['wait'].items():
+            if wait['count']:
+                text += (
+                    f"├ {name}: ожидание p50 {wait['p50_ms']:.0f} / p95 {wait['p95_ms']:.0f} мс, "
+                    f"ждут {m['queued'][name]}, выполнено {m['completed'].get(name, 0)}\n"
+                )
+        text += "\n"
+    
+    await message.answer(text, parse_mode='HTML')
+
+
 # ==================== УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ ====================
 
 @router.message(F.text == "👥 Пользователи")
@@ -229,11 +365,11 @@ async def manage_users(message: Message):
     if not is_admin(message.from_user.id):
         return
     
-    users = await get_all_users()
+    users_count = await count_users()
     
     text = (
         f"👥 <b>Управление пользователями</b>\n\n"
-        f"Всего пользователей: {len(users)}\n\n"
+        f"Всего пользователей: {users_count}\n\n"
         "Выберите действие:"
     )
     
@@ -254,8 +390,8 @@ async def search_user_prompt(callback: CallbackQuery, state: FSMContext):
         "🔍 <b>Поиск пользователя</b>\n\n"
         "Введите:\n"
         "• User ID\n"
-        "• Username (без @)\n"
-        "• Имя пользователя\n\n"
+        "• @username — точный поиск\n"
+        "• Часть имени или username\n\n"
         "Или /cancel для отмены",
         parse_mode='HTML'
     )
@@ -276,7 +412,7 @@ async def process_user_search(message: Message, state: FSMContext):
         return
     
     query = message.text.strip()
-    users = await search_users(query)
+    users = await search_users(query, limit=SEARCH_PAGE_SIZE + 1)
     
     if not users:
         await message.answer(
@@ -286,11 +422,44 @@ async def process_user_search(message: Message, state: FSMContext):
         )
         return
     
-    await state.clear()
+    # Запрос сохраняем для перелистывания страниц
+    await state.set_state(None)
+    await state.update_data(search_query=query)
     
-    result_text = f"🔍 <b>Найдено пользователей: {len(users)}</b>\n\n"
+    text, markup = format_search_results(users, page=0)
+    await message.answer(text, parse_mode='HTML', reply_markup=markup)
+
+
+@router.callback_query(F.data.startswith("search_page_"))
+async def search_results_page(callback: CallbackQuery, state: FSMContext):
+    """Перелистывание результатов поиска"""
+    if not is_admin(callback.from_user.id):
+        return
     
-    for user in users[:10]:  # Показываем первых 10
+    page = int(callback.data.split("_")[2])
+    query = (await state.get_data()).get('search_query')
+    if not query:
+        await callback.answer("❌ Поиск устарел, повторите запрос", show_alert=True)
+        return
+    
+    users = await search_users(query, limit=SEARCH_PAGE_SIZE + 1, offset=page * SEARCH_PAGE_SIZE)
+    if not users:
+        await callback.answer("Больше результатов нет")
+        return
+    
+    text, markup = format_search_results(users, page)
+    await callback.message.edit_text(text, parse_mode='HTML', reply_markup=markup)
+    await callback.answer()
+
+
+def format_search_results(users: list, page: int):
+    """Текст и клавиатура страницы результатов (users — до SEARCH_PAGE_SIZE + 1 строк)"""
+    has_next = len(users) > SEARCH_PAGE_SIZE
+    users = users[:SEARCH_PAGE_SIZE]
+    
+    result_text = f"🔍 <b>Результаты поиска — стр. {page + 1}</b>\n\n"
+    
+    for user in users:
         username = f"@{user['username']}" if user['username'] else "Без username"
         result_text += (
             f"👤 {user['first_name']} {user['last_name'] or ''}\n"
@@ -299,11 +468,7 @@ async def process_user_search(message: Message, state: FSMContext):
             f"📅 Регистрация: {user['registration_date'].strftime('%d.%m.%Y')}\n\n"
         )
     
-    await message.answer(
-        result_text,
-        parse_mode='HTML',
-        reply_markup=get_users_management_keyboard()
-    )
+    return result_text, get_search_results_keyboard(page, has_next)
 
 
 @router.callback_query(F.data.startswith("user_actions_"))
@@ -527,11 +692,12 @@ async def process_broadcast_message(message: Message, state: FSMContext):
         parse_mode='HTML'
     )
     
-    users = await get_all_users()
+    all_count = await count_users()
+    active_count = await count_users_with_active_subscription()
     
     await message.answer(
         f"📊 <b>Подтверждение рассылки</b>\n\n"
-        f"👥 Получателей: {len(users)}\n\n"
+        f"👥 Получателей: {all_count} (с активной подпиской: {active_count})\n\n"
         f"Отправить?",
         parse_mode='HTML',
         reply_markup=get_broadcast_confirm_keyboard()
@@ -553,8 +719,6 @@ async def confirm_broadcast(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ Текст не найден", show_alert=True)
         return
     
-    users = await get_all_users()
-    
     await callback.message.edit_text(
         "📤 <b>Рассылка запущена...</b>\n\n"
         "⏳ Ожидайте...",
@@ -564,7 +728,7 @@ async def confirm_broadcast(callback: CallbackQuery, state: FSMContext):
     success_count = 0
     failed_count = 0
     
-    for user in users:
+    async for user in iter_users(active_only=(target == "active")):
         try:
             await callback.bot.send_message(
                 user['user_id'],
@@ -580,14 +744,14 @@ async def confirm_broadcast(callback: CallbackQuery, state: FSMContext):
         f"✅ <b>Рассылка завершена!</b>\n\n"
         f"📤 Отправлено: {success_count}\n"
         f"❌ Не доставлено: {failed_count}\n"
-        f"👥 Всего: {len(users)}",
+        f"👥 Всего: {success_count + failed_count}",
         parse_mode='HTML',
         reply_markup=get_back_keyboard("admin_back")
     )
     
     await state.clear()
     await callback.answer("✅ Рассылка завершена!")
-    logger.info(f"📢 Админ {callback.from_user.id} выполнил рассылку: {success_count}/{len(users)}")
+    logger.info(f"📢 Админ {callback.from_user.id} выполнил рассылку: {success_count}/{success_count + failed_count}")
 
 
 @router.callback_query(F.data == "broadcast_cancel")
@@ -650,6 +814,7 @@ class AddServerStates(StatesGroup):
     sid           = State()   # short id (можно пусто)
     server_type   = State()   # standard / bypass
     max_clients   = State()   # лимит клиентов
+    inbounds      = State()   # ID inbound'ов панели (и их порты)
 
 
 # ---------------------- Главное меню серверов ----------------------
@@ -664,13 +829,25 @@ async def show_vless_servers(message: Message):
     if not servers:
         text = "Добавленных серверов пока нет.\nНажмите кнопку ниже, чтобы добавить первый!"
     else:
+        health = get_panel_health()
         text = "<b>Активные VLESS-серверы</b>\n\n"
         for s in servers:
             emoji = "Обычный" if s['type'] == 'standard' else "Обход"
+            h = health.get(s['id'], {})
+            if 'healthy' not in h:
+                status = "⏳ ещё не проверен"
+            elif h['healthy'] and h['circuit'] == 'closed':
+                status = f"🟢 {h['rtt_ms']:.0f} мс"
+            else:
+                status = f"🔴 {h.get('error') or 'недоступен'} ({h['circuit']})"
             text += (
                 f"{emoji} <b>{s['name']}</b> (ID: <code>{s['id']}</code>)\n"
                 f"└ IP: <code>{s['ip']}:{s['port']}</code>\n"
-                f"└ Клиентов: {s['current_load']}/{s['max_clients']}\n\n"
+                f"└ Клиентов: {s['current_load']}/{s['max_clients']}\n"
+                f"└ Inbound'ы: " + (", ".join(
+                    f"#{i['inbound_id']} {i['current_load']}/{i['max_clients']}" for i in get_inbounds(s['id'])
+                ) or "нет") + "\n"
+                f"└ Панель: {status}\n\n"
             )
 
     await message.answer(text, parse_mode="HTML", reply_markup=get_vless_servers_keyboard())
@@ -695,7 +872,7 @@ async def start_add_server(callback: CallbackQuery, state: FSMContext):
 
     await callback.message.edit_text(
         "Добавление нового VLESS-сервера\n\n"
-        "<b>Шаг 1 из 8</b>\n"
+        "<b>Шаг 1 из 9</b>\n"
         "Введите название сервера (для себя, например: Москва Reality):",
         parse_mode="HTML",
         reply_markup=get_back_keyboard("servers_back")
@@ -708,7 +885,7 @@ async def start_add_server(callback: CallbackQuery, state: FSMContext):
 @router.message(AddServerStates.name)
 async def step_name(message: Message, state: FSMContext):
     await state.update_data(name=message.text.strip())
-    await message.answer("Шаг 2/8\nВведите IP-адрес сервера (пример: 185.123.45.67):")
+    await message.answer("Шаг 2/9\nВведите IP-адрес сервера (пример: 185.123.45.67):")
     await state.set_state(AddServerStates.ip)
 
 
@@ -722,7 +899,7 @@ async def step_ip(message: Message, state: FSMContext):
         await message.answer("Неверный IP! Попробуйте ещё раз:")
         return
     await state.update_data(ip=ip)
-    await message.answer("Шаг 3/8\nВведите порт панели 3x-ui (обычно 2053 или 54321):")
+    await message.answer("Шаг 3/9\nВведите порт панели 3x-ui (обычно 2053 или 54321):")
     await state.set_state(AddServerStates.port)
 
 
@@ -733,7 +910,7 @@ async def step_port(message: Message, state: FSMContext):
         await message.answer("Порт должен быть числом от 1 до 65535!")
         return
     await state.update_data(port=int(message.text))
-    await message.answer("Шаг 4/8\nВведите секретный путь (пример: mysecret123):")
+    await message.answer("Шаг 4/9\nВведите секретный путь (пример: mysecret123):")
     await state.set_state(AddServerStates.secret)
 
 
@@ -745,7 +922,7 @@ async def step_secret(message: Message, state: FSMContext):
         await message.answer("Секрет слишком короткий!")
         return
     await state.update_data(secret_path=secret)
-    await message.answer("Шаг 5/8\nВведите Public Key (pbk) — ровно 44 символа base64:")
+    await message.answer("Шаг 5/9\nВведите Public Key (pbk) — ровно 44 символа base64:")
     await state.set_state(AddServerStates.pbk)
 
 
@@ -757,7 +934,7 @@ async def step_pbk(message: Message, state: FSMContext):
         await message.answer("Неверный pbk! Должно быть ровно 44 символа base64.")
         return
     await state.update_data(pbk=pbk)
-    await message.answer("Шаг 6/8\nВведите Short ID (sid) — до 16 символов (можно оставить пустым):")
+    await message.answer("Шаг 6/9\nВведите Short ID (sid) — до 16 символов (можно оставить пустым):")
     await state.set_state(AddServerStates.sid)
 
 
@@ -776,7 +953,7 @@ async def step_sid(message: Message, state: FSMContext):
         [InlineKeyboardButton("Обход белых списков", callback_data="srv_type_bypass")],
         [InlineKeyboardButton("Назад", callback_data="servers_back")]
     ])
-    await message.answer("Шаг 7/8\nВыберите тип сервера:", reply_markup=kb)
+    await message.answer("Шаг 7/9\nВыберите тип сервера:", reply_markup=kb)
     await state.set_state(AddServerStates.server_type)
 
 
@@ -786,22 +963,52 @@ async def step_type(callback: CallbackQuery, state: FSMContext):
     stype = "standard" if "standard" in callback.data else "bypass"
     await state.update_data(type=stype)
     await callback.message.edit_text(
-        "Шаг 8/8\nВведите максимальное количество клиентов (по умолчанию 1000):",
+        "Шаг 8/9\nВведите максимальное количество клиентов (по умолчанию 1000):",
         reply_markup=get_back_keyboard("servers_back")
     )
     await state.set_state(AddServerStates.max_clients)
     await callback.answer()
 
 
-# 8. Максимум клиентов → финал
+# 8. Максимум клиентов
 @router.message(AddServerStates.max_clients)
 async def step_max_clients(message: Message, state: FSMContext):
     if not message.text.isdigit() or int(message.text) < 10:
         await message.answer("Минимум 10 клиентов!")
         return
 
+    await state.update_data(max_clients=int(message.text))
+    await message.answer(
+        "Шаг 9/9\nВведите ID inbound'ов панели через запятую, при необходимости с портом "
+        "(пример: <code>1, 2:8443, 3:9443</code>). Клиенты распределяются по ним, "
+        f"не больше {PANEL_INBOUND_MAX_CLIENTS} на inbound:",
+        parse_mode="HTML"
+    )
+    await state.set_state(AddServerStates.inbounds)
+
+
+def parse_inbounds(text: str) -> list[tuple[int, int | None]] | None:
+    """«1, 2:8443» → [(1, None), (2, 8443)]; None — ошибка формата"""
+    inbounds = []
+    for part in text.replace(" ", "").split(","):
+        inbound_id, _, port = part.partition(":")
+        if not inbound_id.isdigit() or (port and not (port.isdigit() and 1 <= int(port) <= 65535)):
+            return None
+        inbounds.append((int(inbound_id), int(port) if port else None))
+    if len({inbound_id for inbound_id, _ in inbounds}) != len(inbounds):
+        return None
+    return inbounds
+
+
+# 9. Inbound'ы → финал
+@router.message(AddServerStates.inbounds)
+async def step_inbounds(message: Message, state: FSMContext):
+    inbounds = parse_inbounds(message.text or "")
+    if not inbounds:
+        await message.answer("Неверный формат! Пример: 1, 2:8443")
+        return
+
     data = await state.get_data()
-    data["max_clients"] = int(message.text)
 
     # Сохраняем в базу
     server_id = await add_vless_server(
@@ -812,8 +1019,12 @@ async def step_max_clients(message: Message, state: FSMContext):
         pbk=data["pbk"],
         sid=data["sid"],
         server_type=data["type"],
-        max_clients=data["max_clients"]
+        max_clients=data["max_clients"],
+        inbounds=inbounds,
+        inbound_max_clients=PANEL_INBOUND_MAX_CLIENTS
     )
+    # Новый сервер сразу участвует в выборе при покупке
+    await load_servers()
 
     type_name = "Обычный" if data["type"] == "standard" else "Обход белых списков"
 
@@ -823,7 +1034,9 @@ async def step_max_clients(message: Message, state: FSMContext):
         f"Название: {data['name']}\n"
         f"Тип: {type_name}\n"
         f"IP: {data['ip']}:{data['port']}\n"
-        f"Макс. клиентов: {data['max_clients']}",
+        f"Макс. клиентов: {data['max_clients']}\n"
+        f"Inbound'ы: {', '.join(str(inbound_id) for inbound_id, _ in inbounds)}\n\n"
+        f"Перенести на него часть клиентов с загруженных серверов: /rebalance {data['type']}",
         parse_mode="HTML",
         reply_markup=get_back_keyboard("admin_back")
     )
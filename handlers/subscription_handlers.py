@@ -10,16 +10,15 @@ from aiogram.fsm.state import State, StatesGroup
 # Прямые импорты — без __init__.py
 from database.db import (
     create_payment, update_payment_status, get_payment_by_id,
-    create_subscription, get_active_subscription, get_user_payments
+    get_active_subscription, get_user_payments
 )
 from keyboards.keyboard import get_payment_keyboard, get_main_menu
-from config import SUBSCRIPTION_PLANS, PAYMENT_PROVIDER_TOKEN, CURRENCY
+from config import SUBSCRIPTION_PLANS, PAYMENT_PROVIDER_TOKEN, CURRENCY, PAYMENT_WEBHOOK_SECRET
 
-# VLESS вместо старого WireGuard
-from utils.vpn_manager import create_vless_user
+# Конфиг выдают воркеры заданий provisioning_jobs
+from utils.provisioning import wake_provisioning
 
 import logging
-from io import BytesIO
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -69,7 +68,8 @@ async def process_plan_selection(callback: CallbackQuery, state: FSMContext):
         amount=plan['price'],
         currency=CURRENCY,
         plan_type=plan['name'],
-        payment_id=payment_id
+        payment_id=payment_id,
+        plan_id=plan_id
     )
     
     order_info = (
@@ -84,6 +84,7 @@ async def process_plan_selection(callback: CallbackQuery, state: FSMContext):
         f"До 5 устройств\n"
         f"Поддержка 24/7\n\n"
         f"Нажмите кнопку ниже для оплаты"
+        + ("\nПодписка активируется автоматически после оплаты" if PAYMENT_WEBHOOK_SECRET else "")
     )
     
     payment_url = f"https://payment.example.com/pay/{payment_id}"  # Замени на реальный URL при интеграции
@@ -91,7 +92,7 @@ async def process_plan_selection(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
         order_info,
         parse_mode='HTML',
-        reply_markup=get_payment_keyboard(payment_url, payment_id)
+        reply_markup=get_payment_keyboard(payment_url, payment_id, with_check=not PAYMENT_WEBHOOK_SECRET)
     )
     
     await state.set_state(PaymentStates.waiting_payment)
@@ -114,62 +115,34 @@ async def check_payment(callback: CallbackQuery, state: FSMContext):
         await callback.answer("Платёж уже обработан!", show_alert=True)
         return
     
+    if PAYMENT_WEBHOOK_SECRET:
+        # Об оплате сообщает сама платёжная система (utils/payment_webhook.py) — кнопка
+        # со старых сообщений ничего не подтверждает
+        await callback.answer("Платёж ещё не поступил. Конфиг придёт сюда сразу после оплаты.", show_alert=True)
+        return
+    
     # === Имитация успешной оплаты ===
     payment_status = 'succeeded'  # В реальности — запрос к платёжной системе
     
     if payment_status == 'succeeded':
-        await update_payment_status(payment_id, 'succeeded')
-        data = await state.get_data()
-        plan_type = data.get('plan_type', 'Подписка')
-        duration_days = data.get('duration_days', 30)
-        
-        # Генерируем VLESS конфиг
-        vless_result = await create_vless_user(server_type="standard")
-        if not vless_result:
-            await callback.message.answer("Серверы временно недоступны. Попробуйте позже.")
-            await callback.answer()
-            return
-        
-        vpn_config = vless_result["config"]
-        email = vless_result["email"]
-        
-        # Создаём подписку
-        subscription = await create_subscription(
-            user_id=user_id,
-            plan_type=plan_type,
-            duration_days=duration_days,
-            vpn_config=vpn_config,
-            vpn_login=email,
-            vpn_password=vless_result["uuid"][:16]
-        )
-        
-        # Отправляем конфиг
-        config_file = BytesIO(vpn_config.encode('utf-8'))
-        config_file.name = f"vless_config_{user_id}.txt"
-        
-        success_text = (
-            f"<b>Оплата прошла успешно!</b>\n\n"
-            f"Подписка активирована\n"
-            f"Тариф: {plan_type}\n"
-            f"Действует до: {subscription['end_date'].strftime('%d.%m.%Y %H:%M')}\n\n"
-            f"Ваш VLESS конфиг прикреплён ниже\n\n"
-            f"Инструкция по подключению: /help"
-        )
+        # Тариф — из самого платежа, а не из FSM-состояния, которое могло потеряться
+        plan = SUBSCRIPTION_PLANS.get(payment['plan_id'] or '')
+        # Панель и подписка — в фоне (utils/provisioning.py): обработчик только ставит задание
+        await update_payment_status(payment_id, 'succeeded', job={
+            "user_id": user_id,
+            "plan_type": payment['plan_type'] or 'Подписка',
+            "duration_days": plan['duration_days'] if plan else 30,
+        })
+        wake_provisioning()
         
         await callback.message.delete()
         await callback.message.answer(
-            success_text,
-            parse_mode='HTML',
-            reply_markup=get_main_menu(is_subscribed=True)
-        )
-        await callback.message.answer_document(
-            document=config_file,
-            caption="Ваш VLESS конфиг (импортируйте в Nekobox, v2rayNG, Streisand и т.д.)"
+            "<b>Оплата получена!</b>\n\n"
+            "Готовим ваш VLESS конфиг — он придёт сюда через несколько секунд.",
+            parse_mode='HTML'
         )
-        
         await state.clear()
-        await callback.answer("Подписка активирована!", show_alert=True)
-        logger.info(f"Подписка создана для {user_id} — {plan_type}")
+        await callback.answer("Оплата получена!")
         
     else:
         await callback.answer("Платёж ещё не поступил. Попробуйте позже.", show_alert=True)
@@ -229,42 +202,27 @@ async def successful_payment(message: Message):
     
     plan = SUBSCRIPTION_PLANS[plan_id]
     
-    # Создаём платёж
+    payment_id = message.successful_payment.telegram_payment_charge_id
     await create_payment(
         user_id=user_id,
         amount=message.successful_payment.total_amount / 100,
         currency=message.successful_payment.currency,
         plan_type=plan['name'],
-        payment_id=message.successful_payment.telegram_payment_charge_id
-    )
-    await update_payment_status(message.successful_payment.telegram_payment_charge_id, 'succeeded')
-    
-    # Генерируем VLESS
-    vless = await create_vless_user(server_type="standard")
-    if not vless:
-        await message.answer("Ошибка создания конфигурации. Обратитесь в поддержку.")
-        return
-    
-    subscription = await create_subscription(
-        user_id=user_id,
-        plan_type=plan['name'],
-        duration_days=plan['duration_days'],
-        vpn_config=vless["config"],
-        vpn_login=vless["email"],
-        vpn_password=vless["uuid"][:16]
+        payment_id=payment_id,
+        plan_id=plan_id
     )
-    
-    config_file = BytesIO(vless["config"].encode('utf-8'))
-    config_file.name = f"vless_{user_id}.txt"
+    await update_payment_status(payment_id, 'succeeded', job={
+        "user_id": user_id,
+        "plan_type": plan['name'],
+        "duration_days": plan['duration_days'],
+    })
+    wake_provisioning()
     
     await message.answer(
-        f"<b>Спасибо за покупку!</b>\n\n"
-        f"Подписка активирована до {subscription['end_date'].strftime('%d.%m.%Y')}\n\n"
-        f"Конфиг ниже",
-        parse_mode='HTML',
-        reply_markup=get_main_menu(is_subscribed=True)
+        "<b>Спасибо за покупку!</b>\n\n"
+        "Готовим ваш VLESS конфиг — он придёт сюда через несколько секунд.",
+        parse_mode='HTML'
     )
-    await message.answer_document(config_file, caption="VLESS Reality конфиг")
 
 
 # История платежей
@@ -5,7 +5,7 @@ from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, CallbackQuery, BufferedInputFile
 from aiogram.fsm.context import FSMContext
 from database.db import (
-    get_user, create_user, get_active_subscription, is_user_banned
+    get_user, create_user, get_active_subscription, is_user_banned, get_client_traffic
 )
 from keyboards.keyboard import (
     get_main_menu, get_subscription_plans_keyboard, get_plan_details_keyboard,
@@ -472,20 +472,39 @@ async def show_instructions(callback: CallbackQuery):
 
 # ==================== СТАТИСТИКА ПОДПИСКИ ====================
 
+def format_traffic(size: int) -> str:
+    """Байты в человекочитаемый вид"""
+    size = float(size)
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "Б" else f"{int(size)} {unit}"
+        size /= 1024
+    return f"{size:.2f} ТБ"
+
+
 @router.callback_query(F.data == "sub_stats")
 async def show_sub_stats(callback: CallbackQuery):
-    """Статистика использования (заглушка для будущего)"""
+    """Статистика использования по агрегатам трафика клиента"""
+    subscription = await get_active_subscription(callback.from_user.id)
+
+    if not subscription or not subscription.get('vpn_login'):
+        await callback.answer("❌ У вас нет активной подписки", show_alert=True)
+        return
+
+    traffic = await get_client_traffic(subscription['vpn_login'], subscription['start_date'])
+    last_seen = traffic['last_seen']
     stats_text = (
         "📊 <b>Статистика использования</b>\n\n"
         "━━━━━━━━━━━━━━━\n"
-        "📈 Трафик: ∞ (безлимит)\n"
-        "⏱ Время подключения: 247 ч.\n"
-        "🌍 Серверов использовано: 5\n"
-        "📱 Устройств: 3 из 5\n"
+        f"📈 Трафик за подписку: {format_traffic(traffic['up'] + traffic['down'])}\n"
+        f"└ ⬇️ {format_traffic(traffic['down'])} / ⬆️ {format_traffic(traffic['up'])}\n"
+        f"🕐 За последние 24 ч.: {format_traffic(traffic['last_day'])}\n"
+        f"🌍 Серверов использовано: {traffic['servers']}\n"
+        f"📡 Последняя активность: {last_seen.strftime('%d.%m.%Y %H:%M') if last_seen else 'нет данных'}\n"
         "━━━━━━━━━━━━━━━\n\n"
-        "<i>Данные обновляются раз в час</i>"
+        "<i>Данные обновляются каждые несколько минут</i>"
     )
-    
+
     await callback.message.edit_text(
         stats_text,
         parse_mode='HTML',
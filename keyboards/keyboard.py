@@ -87,16 +87,13 @@ def get_plan_details_keyboard(plan_id: str):
 
 # ==================== ОПЛАТА ====================
 
-def get_payment_keyboard(payment_url: str, payment_id: str):
-    """Кнопки для оплаты"""
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="💳 Оплатить онлайн", url=payment_url)],
-            [InlineKeyboardButton(text="✅ Я оплатил", callback_data=f"check_payment_{payment_id}")],
-            [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_payment")]
-        ]
-    )
-    return keyboard
+def get_payment_keyboard(payment_url: str, payment_id: str, with_check: bool = True):
+    """Кнопки для оплаты (with_check=False — об оплате сообщает webhook, кнопка «Я оплатил» не нужна)"""
+    buttons = [[InlineKeyboardButton(text="💳 Оплатить онлайн", url=payment_url)]]
+    if with_check:
+        buttons.append([InlineKeyboardButton(text="✅ Я оплатил", callback_data=f"check_payment_{payment_id}")])
+    buttons.append([InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_payment")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
 # ==================== МОЯ ПОДПИСКА ====================
@@ -204,6 +201,21 @@ def get_users_management_keyboard(page: int = 0):
     return keyboard
 
 
+def get_search_results_keyboard(page: int, has_next: bool):
+    """Пагинация результатов поиска пользователей"""
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"search_page_{page - 1}"))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"search_page_{page + 1}"))
+    
+    buttons = [nav_buttons] if nav_buttons else []
+    buttons.append([InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search_user")])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_users")])
+    
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
 def get_user_actions_keyboard(user_id: int):
     """Действия с пользователем"""
     keyboard = InlineKeyboardMarkup(
@@ -7,6 +7,12 @@ from aiogram.fsm.storage.memory import MemoryStorage
 # ИМПОРТЫ
 from config import BOT_TOKEN
 from database.db import init_db, close_db
+from utils.vpn_manager import init_vpn_manager, close_vpn_manager
+from utils.traffic_collector import init_traffic_collector, close_traffic_collector
+from utils.reconciler import init_reconciler, close_reconciler
+from utils.rebalancer import init_rebalancer, close_rebalancer
+from utils.provisioning import init_provisioning, close_provisioning
+from utils.payment_webhook import init_payment_webhook, close_payment_webhook
 from middlewares.auth_middleware import AuthMiddleware
 from handlers.user_handlers import router as user_router
 from handlers.admin_handlers import router as admin_router
@@ -36,6 +42,13 @@ async def main():
     await init_db()
     logger.info("✅ База данных инициализирована")
     
+    await init_vpn_manager()
+    init_traffic_collector()
+    init_reconciler()
+    init_rebalancer(bot)
+    init_provisioning(bot)
+    await init_payment_webhook()
+    
     # Подключение middleware
     dp.message.middleware(AuthMiddleware())
     dp.callback_query.middleware(AuthMiddleware())
@@ -54,7 +67,13 @@ async def main():
         logger.info("━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
+        await close_payment_webhook()
+        await close_provisioning()
         await bot.session.close()
+        await close_traffic_collector()
+        await close_reconciler()
+        await close_rebalancer()
+        await close_vpn_manager()
         await close_db()
         logger.info("⛔ Бот остановлен")
 
@@ -0,0 +1,70 @@
+# utils/fake_payment_provider.py — локальная замена платёжной системы: подписывает и шлёт уведомления
+#
+#   python -m utils.fake_payment_provider pay_123456789_1700000000 --amount 299
+#   python -m utils.fake_payment_provider pay_123456789_1700000000 --amount 299 --repeat 3
+#   python -m utils.fake_payment_provider pay_123456789_1700000000 --event payment.canceled
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import uuid
+
+import aiohttp
+
+from config import CURRENCY, PAYMENT_WEBHOOK_SECRET, PAYMENT_WEBHOOK_PORT, PAYMENT_WEBHOOK_PATH
+
+
+def build_notification(payment_id: str, event: str, amount: float, currency: str) -> dict:
+    """Тело уведомления в формате YooKassa"""
+    return {
+        "type": "notification",
+        "event": event,
+        "object": {
+            "id": payment_id,
+            "status": event.split(".", 1)[1],
+            "paid": event == "payment.succeeded",
+            "amount": {"value": f"{amount:.2f}", "currency": currency},
+            "metadata": {"notification_id": str(uuid.uuid4())},
+        },
+    }
+
+
+def sign(body: bytes, secret: str) -> str:
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+async def send(url: str, body: bytes, secret: str, repeat: int = 1):
+    async with aiohttp.ClientSession() as session:
+        for i in range(repeat):
+            async with session.post(
+                url,
+                data=body,
+                headers={"Content-Type": "application/json", "X-Webhook-Signature": sign(body, secret)}
+            ) as resp:
+                print(f"#{i + 1}: HTTP {resp.status}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отправить боту подписанное уведомление об оплате")
+    parser.add_argument("payment_id", help="ID платежа из сообщения «Ваш заказ»")
+    parser.add_argument("--event", default="payment.succeeded", choices=["payment.succeeded", "payment.canceled"])
+    parser.add_argument("--amount", type=float, help="сумма тарифа, должна совпасть с платежом")
+    parser.add_argument("--currency", default=CURRENCY)
+    parser.add_argument("--url", default=f"http://127.0.0.1:{PAYMENT_WEBHOOK_PORT}{PAYMENT_WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=PAYMENT_WEBHOOK_SECRET)
+    parser.add_argument("--repeat", type=int, default=1, help="повторная доставка (проверка идемпотентности)")
+    parser.add_argument("--bad-signature", action="store_true", help="подписать чужим секретом (ожидается 401)")
+    args = parser.parse_args()
+
+    if not args.secret:
+        parser.error("PAYMENT_WEBHOOK_SECRET не задан (.env или --secret)")
+    if args.event == "payment.succeeded" and args.amount is None:
+        parser.error("для payment.succeeded нужна --amount")
+    body = json.dumps(build_notification(args.payment_id, args.event, args.amount or 0, args.currency)).encode()
+    secret = args.secret + "x" if args.bad_signature else args.secret
+    asyncio.run(send(args.url, body, secret, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
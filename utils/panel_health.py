@@ -0,0 +1,109 @@
+# utils/panel_health.py — здоровье панелей 3X-UI и circuit breaker на каждый сервер
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from config import PANEL_CB_FAILURE_THRESHOLD, PANEL_CB_OPEN_SECONDS, PANEL_PROBE_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """closed → (N ошибок подряд) → open → (PANEL_CB_OPEN_SECONDS) → half-open → проба решает"""
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= PANEL_CB_OPEN_SECONDS:
+            return "half_open"
+        return "open"
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= PANEL_CB_FAILURE_THRESHOLD:
+            # Из half-open сразу обратно в open с новым отсчётом
+            self.opened_at = time.monotonic()
+
+
+_breakers: Dict[int, CircuitBreaker] = {}
+# server_id -> результат последней пробы
+_health: Dict[int, Dict[str, Any]] = {}
+
+
+def _breaker(server_id: int) -> CircuitBreaker:
+    breaker = _breakers.get(server_id)
+    if breaker is None:
+        breaker = _breakers[server_id] = CircuitBreaker()
+    return breaker
+
+
+def is_available(server_id: int) -> bool:
+    """Можно ли слать пользовательский трафик: только при закрытом breaker (half-open проверяет проба)"""
+    return _breaker(server_id).state == "closed"
+
+
+def record_success(server_id: int):
+    _breaker(server_id).record_success()
+
+
+def record_failure(server_id: int):
+    breaker = _breaker(server_id)
+    was_closed = breaker.state == "closed"
+    breaker.record_failure()
+    if was_closed and breaker.state != "closed":
+        logger.warning(f"⛔ Панель сервера {server_id} исключена из выбора: {breaker.failures} ошибок подряд")
+
+
+def get_panel_health() -> Dict[int, Dict[str, Any]]:
+    """Последние пробы и состояние breaker'ов по server_id (для админки)"""
+    return {
+        server_id: {**_health.get(server_id, {}), "circuit": _breaker(server_id).state}
+        for server_id in set(_health) | set(_breakers)
+    }
+
+
+async def _probe(server: Dict):
+    # Ленивый импорт: vpn_manager сам импортирует этот модуль
+    from utils.vpn_manager import panel_request
+
+    started = time.perf_counter()
+    error = None
+    try:
+        status, _ = await asyncio.wait_for(
+            # Мимо очереди планировщика: проба измеряет саму панель, а не нашу очередь к ней
+            panel_request(server, "server/status", check_circuit=False, priority=None),
+            timeout=PANEL_PROBE_TIMEOUT_SECONDS
+        )
+        if status != 200:
+            error = f"HTTP {status}" if status else "login failed"
+    except asyncio.TimeoutError:
+        error = "timeout"
+    except Exception as e:
+        error = str(e) or type(e).__name__
+
+    if error:
+        record_failure(server['id'])
+    else:
+        record_success(server['id'])
+    _health[server['id']] = {
+        "healthy": error is None,
+        "rtt_ms": round((time.perf_counter() - started) * 1000, 1),
+        "checked_at": datetime.now(),
+        "error": error,
+    }
+
+
+async def probe_panels(servers: List[Dict]):
+    """Параллельно опросить все панели и обновить их breaker'ы"""
+    await asyncio.gather(*(_probe(server) for server in servers))
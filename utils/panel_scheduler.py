@@ -0,0 +1,117 @@
+# utils/panel_scheduler.py — ограничение параллельных запросов к панели и очередь с приоритетами
+import asyncio
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Any, Optional, Tuple
+
+from database.pool_metrics import LatencyHistogram
+from config import PANEL_MAX_CONCURRENCY, PANEL_SCHEDULER_AGING_SECONDS
+
+# Меньше — важнее. Покупка не должна ждать за удалениями и фоновыми задачами
+PRIORITY_CHECKOUT = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_MAINTENANCE = 2
+PRIORITY_NAMES = {
+    PRIORITY_CHECKOUT: "checkout",
+    PRIORITY_DEFAULT: "default",
+    PRIORITY_MAINTENANCE: "maintenance",
+}
+
+
+class PanelScheduler:
+    """Не больше limit одновременных запросов к одной панели
+
+    Ожидающие стоят в FIFO-очереди своего приоритета; освободившийся слот получает
+    самый важный из них. Чтобы фоновые задачи не голодали при постоянном потоке
+    покупок, ожидающий дольше PANEL_SCHEDULER_AGING_SECONDS проходит вне очереди.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._active = 0
+        self._queues: Dict[int, Deque[Tuple[float, asyncio.Future]]] = {p: deque() for p in PRIORITY_NAMES}
+        self.wait: Dict[int, LatencyHistogram] = {p: LatencyHistogram() for p in PRIORITY_NAMES}
+        self.completed: Dict[int, int] = defaultdict(int)
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_DEFAULT):
+        started = time.perf_counter()
+        if self._active < self.limit and not self.depth:
+            self._active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            entry = (started, future)
+            self._queues[priority].append(entry)
+            self.max_depth = max(self.max_depth, self.depth)
+            try:
+                # Слот передаётся из _release() вместе со счётчиком _active
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Слот уже отдан нам — возвращаем его следующему
+                    self._release()
+                elif entry in self._queues[priority]:
+                    self._queues[priority].remove(entry)
+                raise
+        self.wait[priority].observe((time.perf_counter() - started) * 1000)
+        try:
+            yield
+        finally:
+            self.completed[priority] += 1
+            self._release()
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        now = time.perf_counter()
+        aged = [
+            (queue[0][0], priority) for priority, queue in self._queues.items()
+            if queue and priority != PRIORITY_CHECKOUT and now - queue[0][0] >= PANEL_SCHEDULER_AGING_SECONDS
+        ]
+        if aged:
+            priority = min(aged)[1]
+        else:
+            priority = next((p for p in sorted(self._queues) if self._queues[p]), None)
+            if priority is None:
+                return None
+        return self._queues[priority].popleft()[1]
+
+    def _release(self):
+        while True:
+            future = self._next_waiter()
+            if future is None:
+                self._active -= 1
+                return
+            # Отменённые ожидания пропускаем — их задачи сами уберут себя из очереди
+            if not future.done():
+                future.set_result(None)
+                return
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self._active,
+            "queued": {PRIORITY_NAMES[p]: len(q) for p, q in self._queues.items()},
+            "max_depth": self.max_depth,
+            "wait": {PRIORITY_NAMES[p]: h.snapshot() for p, h in self.wait.items()},
+            "completed": {PRIORITY_NAMES[p]: n for p, n in self.completed.items()},
+        }
+
+
+_schedulers: Dict[int, PanelScheduler] = {}
+
+
+def get_scheduler(server_id: int) -> PanelScheduler:
+    scheduler = _schedulers.get(server_id)
+    if scheduler is None:
+        scheduler = _schedulers[server_id] = PanelScheduler(PANEL_MAX_CONCURRENCY)
+    return scheduler
+
+
+def get_scheduler_metrics() -> Dict[int, Dict[str, Any]]:
+    """Глубина очередей, ожидание слота и выполненные запросы по server_id"""
+    return {server_id: scheduler.snapshot() for server_id, scheduler in _schedulers.items()}
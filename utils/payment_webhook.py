@@ -0,0 +1,113 @@
+# utils/payment_webhook.py — приём уведомлений платёжной системы (в формате YooKassa)
+import hashlib
+import hmac
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Optional
+
+from aiohttp import web
+
+from database.db import get_payment_by_id, update_payment_status
+from config import (
+    SUBSCRIPTION_PLANS, PAYMENT_WEBHOOK_SECRET, PAYMENT_WEBHOOK_HOST,
+    PAYMENT_WEBHOOK_PORT, PAYMENT_WEBHOOK_PATH
+)
+from utils.provisioning import wake_provisioning
+
+logger = logging.getLogger(__name__)
+
+# HMAC-SHA256 тела запроса (hex) общим секретом PAYMENT_WEBHOOK_SECRET
+SIGNATURE_HEADER = "X-Webhook-Signature"
+
+_runner: Optional[web.AppRunner] = None
+
+
+def verify_signature(body: bytes, signature: str) -> bool:
+    expected = hmac.new(PAYMENT_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    # Байты, а не str: compare_digest(str, str) падает на не-ASCII заголовке
+    return hmac.compare_digest(expected.encode(), signature.strip().lower().encode(errors="replace"))
+
+
+def _amount_matches(payment: Dict, amount: Optional[Dict]) -> bool:
+    """Сумма и валюта уведомления совпадают с созданным платежом"""
+    if not isinstance(amount, dict):
+        return False
+    try:
+        # Сравнение тоже внутри try: "sNaN" разбирается, но бросает InvalidOperation при ==
+        return (
+            Decimal(str(amount['value'])) == Decimal(str(payment['amount']))
+            and amount.get('currency') == payment['currency']
+        )
+    except (KeyError, InvalidOperation):
+        return False
+
+
+async def handle_notification(request: web.Request) -> web.Response:
+    """POST {"event": "payment.succeeded" | "payment.canceled", "object": {"id", "amount", ...}}
+
+    Повторная доставка того же уведомления безопасна: статус меняется условно, а задание
+    на выдачу ставится INSERT IGNORE по payment_id. 200 — обработано (или повтор),
+    иначе платёжная система доставит уведомление ещё раз.
+    """
+    body = await request.read()
+    if not verify_signature(body, request.headers.get(SIGNATURE_HEADER, "")):
+        logger.warning(f"Payment webhook: bad signature from {request.remote}")
+        return web.Response(status=401)
+
+    try:
+        notification = json.loads(body)
+        event = notification['event']
+        obj = notification['object']
+        payment_id = str(obj['id'])
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+    if not isinstance(obj, dict):
+        return web.Response(status=400)
+
+    payment = await get_payment_by_id(payment_id)
+    if payment is None:
+        logger.warning(f"Payment webhook: unknown payment {payment_id}")
+        return web.Response(status=404)
+
+    if event == 'payment.succeeded':
+        if not _amount_matches(payment, obj.get('amount')):
+            logger.error(f"Payment webhook: amount mismatch for {payment_id}: {obj.get('amount')}")
+            return web.Response(status=400)
+        plan = SUBSCRIPTION_PLANS.get(payment['plan_id'] or '')
+        changed = await update_payment_status(payment_id, 'succeeded', job={
+            "user_id": payment['user_id'],
+            "plan_type": payment['plan_type'],
+            "duration_days": plan['duration_days'] if plan else 30,
+        })
+        if changed:
+            wake_provisioning()
+            logger.info(f"💳 Оплата {payment_id} подтверждена, выдача конфига {payment['user_id']} в очереди")
+    elif event == 'payment.canceled':
+        # Отмена не откатывает уже прошедшую оплату
+        if payment['status'] == 'pending':
+            await update_payment_status(payment_id, 'cancelled')
+    else:
+        logger.info(f"Payment webhook: ignored event {event} for {payment_id}")
+
+    return web.Response(status=200)
+
+
+async def init_payment_webhook():
+    """Поднять HTTP-приёмник уведомлений в процессе бота (без PAYMENT_WEBHOOK_SECRET — выключен)"""
+    global _runner
+    if not PAYMENT_WEBHOOK_SECRET:
+        return
+    app = web.Application()
+    app.router.add_post(PAYMENT_WEBHOOK_PATH, handle_notification)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, PAYMENT_WEBHOOK_HOST, PAYMENT_WEBHOOK_PORT).start()
+    logger.info(f"✅ Приём уведомлений об оплате: {PAYMENT_WEBHOOK_HOST}:{PAYMENT_WEBHOOK_PORT}{PAYMENT_WEBHOOK_PATH}")
+
+
+async def close_payment_webhook():
+    global _runner
+    if _runner:
+        await _runner.cleanup()
+        _runner = None
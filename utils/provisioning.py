@@ -0,0 +1,155 @@
+# utils/provisioning.py — выдача конфига после оплаты: очередь заданий и пул воркеров
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+from aiogram import Bot
+from aiogram.types import BufferedInputFile
+
+from database.db import (
+    claim_provisioning_job, save_provisioning_client, complete_provisioning_job,
+    fail_provisioning_job, create_subscription, get_active_subscription
+)
+from config import (
+    PROVISION_WORKERS, PROVISION_JOB_POLL_SECONDS, PROVISION_JOB_MAX_ATTEMPTS,
+    PROVISION_JOB_RETRY_SECONDS, PROVISION_JOB_LEASE_SECONDS
+)
+from keyboards.keyboard import get_main_menu
+from utils.vpn_manager import create_vless_user
+
+logger = logging.getLogger(__name__)
+
+_bot: Optional[Bot] = None
+_workers: List[asyncio.Task] = []
+_jobs_wakeup = asyncio.Event()
+
+
+def wake_provisioning():
+    """Разбудить воркеры сразу после постановки задания (иначе — через PROVISION_JOB_POLL_SECONDS)"""
+    _jobs_wakeup.set()
+
+
+async def _process(job: dict):
+    """Довести задание до конца, начиная с сохранённого шага
+
+    Шаги: клиент на панели (client_uuid) → подписка (subscription_id) → отправка конфига.
+    Отправка — «хотя бы один раз»: после падения между ней и complete конфиг придёт повторно.
+    """
+    end_date: Optional[datetime] = None
+    if job['subscription_id'] is None:
+        if job['client_uuid'] is None:
+            vless = await create_vless_user(server_type=job['server_type'])
+            if not vless:
+                raise RuntimeError("no server available")
+            await save_provisioning_client(job['id'], vless)
+            job.update(
+                client_uuid=vless['uuid'], client_email=vless['email'], server_id=vless['server_id'],
+                inbound_id=vless['inbound_id'], vpn_config=vless['config']
+            )
+        subscription = await create_subscription(
+            user_id=job['user_id'],
+            plan_type=job['plan_type'],
+            duration_days=job['duration_days'],
+            vpn_config=job['vpn_config'],
+            vpn_login=job['client_email'],
+            vpn_password=job['client_uuid'][:16],
+            server_id=job['server_id'],
+            inbound_id=job['inbound_id'],
+            client_uuid=job['client_uuid'],
+            job_id=job['id']
+        )
+        end_date = subscription['end_date']
+    else:
+        subscription = await get_active_subscription(job['user_id'])
+        if subscription:
+            end_date = subscription['end_date']
+
+    await _deliver(job, end_date)
+    await complete_provisioning_job(job['id'])
+    logger.info(f"Подписка создана для {job['user_id']} — {job['plan_type']} (задание #{job['id']})")
+
+
+async def _deliver(job: dict, end_date: Optional[datetime]):
+    until = f"Действует до: {end_date.strftime('%d.%m.%Y %H:%M')}\n\n" if end_date else "\n"
+    try:
+        await _bot.send_message(
+            job['user_id'],
+            f"<b>Оплата прошла успешно!</b>\n\n"
+            f"Подписка активирована\n"
+            f"Тариф: {job['plan_type']}\n"
+            f"{until}"
+            f"Ваш VLESS конфиг прикреплён ниже\n\n"
+            f"Инструкция по подключению: /help",
+            parse_mode='HTML',
+            reply_markup=get_main_menu(is_subscribed=True)
+        )
+        await _bot.send_document(
+            job['user_id'],
+            BufferedInputFile(job['vpn_config'].encode('utf-8'), filename=f"vless_config_{job['user_id']}.txt"),
+            caption="Ваш VLESS конфиг (импортируйте в Nekobox, v2rayNG, Streisand и т.д.)"
+        )
+    except Exception as e:
+        # Пользователь заблокировал бота и т.п. — конфиг всё равно доступен в «Моя подписка»
+        logger.warning(f"Не удалось отправить конфиг {job['user_id']}: {e}")
+
+
+async def _handle_failure(job: dict, error: Exception):
+    if job['attempts'] < PROVISION_JOB_MAX_ATTEMPTS:
+        # Экспоненциальная пауза: панели успевают подняться, circuit breaker — закрыться
+        retry_in = PROVISION_JOB_RETRY_SECONDS * 2 ** (job['attempts'] - 1)
+        logger.warning(f"Provisioning job {job['id']} attempt {job['attempts']} failed: {error}, retry in {retry_in:.0f}s")
+        await fail_provisioning_job(job['id'], str(error), retry_in)
+        return
+
+    logger.error(f"Provisioning job {job['id']} failed after {job['attempts']} attempts: {error}")
+    await fail_provisioning_job(job['id'], str(error))
+    try:
+        await _bot.send_message(
+            job['user_id'],
+            f"Не удалось выдать конфиг после оплаты (платёж <code>{job['payment_id']}</code>).\n"
+            f"Обратитесь в поддержку — подписку активируем вручную.",
+            parse_mode='HTML'
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось уведомить {job['user_id']} об ошибке выдачи: {e}")
+
+
+async def _worker():
+    while True:
+        try:
+            job = await claim_provisioning_job(PROVISION_JOB_LEASE_SECONDS)
+        except Exception as e:
+            logger.error(f"Claiming provisioning job failed: {e}")
+            job = None
+        if job is None:
+            try:
+                await asyncio.wait_for(_jobs_wakeup.wait(), timeout=PROVISION_JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            _jobs_wakeup.clear()
+            continue
+
+        try:
+            await _process(job)
+        except Exception as e:
+            try:
+                await _handle_failure(job, e)
+            except Exception as db_error:
+                # Аренда истечёт, и задание подхватит следующий проход
+                logger.error(f"Provisioning job {job['id']} state not saved: {db_error}")
+
+
+def init_provisioning(bot: Bot):
+    """Запустить воркеры; задания, прерванные остановкой бота, подхватятся после истечения аренды"""
+    global _bot
+    _bot = bot
+    for _ in range(PROVISION_WORKERS):
+        _workers.append(asyncio.create_task(_worker()))
+
+
+async def close_provisioning():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
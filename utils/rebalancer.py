@@ -0,0 +1,310 @@
+# utils/rebalancer.py — перенос клиентов с перегруженных серверов на свободные
+import asyncio
+import logging
+import math
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.types import BufferedInputFile
+
+from database.db import (
+    get_movable_subscriptions, create_rebalance_run, get_unfinished_rebalance_runs,
+    get_rebalance_moves, update_rebalance_move, switch_subscription_client, finish_rebalance_run,
+    rebalance_run_lock
+)
+from config import (
+    REBALANCE_TOLERANCE, REBALANCE_MAX_MOVES, REBALANCE_BATCH_SIZE,
+    REBALANCE_BATCH_INTERVAL_SECONDS, REBALANCE_PANEL_CONCURRENCY, REBALANCE_GRACE_SECONDS
+)
+from utils.server_registry import get_active_servers, get_server, get_inbound
+from utils.panel_health import is_available
+from utils.panel_scheduler import PRIORITY_MAINTENANCE
+from utils.vpn_manager import (
+    new_client, provision_on_server, delete_vless_user, build_config, fetch_inbounds, inbound_clients
+)
+
+logger = logging.getLogger(__name__)
+
+# Состояния перемещения: pending → creating → created → switched → done (или failed).
+# В switched старый клиент живёт ещё REBALANCE_GRACE_SECONDS после уведомления пользователя
+UNFINISHED_STATUSES = ['pending', 'creating', 'created', 'switched']
+
+# Не больше REBALANCE_PANEL_CONCURRENCY одновременных операций переноса на одну панель
+_panel_limits: Dict[int, asyncio.Semaphore] = defaultdict(
+    lambda: asyncio.Semaphore(REBALANCE_PANEL_CONCURRENCY)
+)
+# Переносы выполняются строго по одному (между процессами — ещё и GET_LOCK на каждый перенос)
+_run_lock = asyncio.Lock()
+_background_tasks: Set[asyncio.Task] = set()
+# Переносы, повторный проход которых уже запланирован (ждут конца льготного периода)
+_scheduled_runs: Set[int] = set()
+
+
+def _ratio(load: int, server: Dict) -> float:
+    return load / max(server['max_clients'] or 1, 1)
+
+
+async def plan_rebalance(server_type: str = "standard", max_moves: int = REBALANCE_MAX_MOVES) -> List[Dict]:
+    """План переноса (dry-run — ничего не меняет)
+
+    Целевая загрузка — средняя доля по доступным серверам типа. Серверы выше неё
+    больше чем на REBALANCE_TOLERANCE отдают клиентов, серверы ниже — принимают.
+    """
+    servers = [s for s in get_active_servers(server_type) if is_available(s['id'])]
+    capacity = sum(s['max_clients'] for s in servers)
+    if not capacity:
+        return []
+    target = sum(s['current_load'] for s in servers) / capacity
+
+    load = {s['id']: s['current_load'] for s in servers}
+    room = {
+        s['id']: math.floor(target * s['max_clients']) - s['current_load']
+        for s in servers if _ratio(s['current_load'], s) < target
+    }
+    sources = sorted(
+        (s for s in servers if _ratio(s['current_load'], s) > target + REBALANCE_TOLERANCE),
+        key=lambda s: _ratio(s['current_load'], s),
+        reverse=True
+    )
+
+    moves = []
+    for source in sources:
+        surplus = source['current_load'] - math.ceil(target * source['max_clients'])
+        limit = min(surplus, max_moves - len(moves))
+        if limit <= 0:
+            continue
+        for sub in await get_movable_subscriptions(source['id'], limit):
+            # Каждого клиента — на сервер, который сейчас меньше всех загружен
+            candidates = [s for s in servers if room.get(s['id'], 0) > 0]
+            if not candidates:
+                return moves
+            dest = min(candidates, key=lambda s: _ratio(load[s['id']], s))
+            room[dest['id']] -= 1
+            load[dest['id']] += 1
+            load[source['id']] -= 1
+            moves.append({
+                "subscription_id": sub['id'],
+                "user_id": sub['user_id'],
+                "from_server_id": source['id'],
+                "from_inbound_id": sub['inbound_id'],
+                "old_uuid": sub['client_uuid'],
+                "to_server_id": dest['id'],
+            })
+    return moves
+
+
+def summarize_plan(moves: List[Dict]) -> Dict[tuple, int]:
+    """(откуда, куда) -> сколько клиентов"""
+    summary: Dict[tuple, int] = defaultdict(int)
+    for move in moves:
+        summary[(move['from_server_id'], move['to_server_id'])] += 1
+    return dict(summary)
+
+
+async def start_rebalance(bot: Bot, server_type: str = "standard") -> Optional[int]:
+    """Составить план, сохранить его и запустить перенос в фоне; None — переносить нечего"""
+    moves = await plan_rebalance(server_type)
+    if not moves:
+        return None
+    run_id = await create_rebalance_run(server_type, moves)
+    logger.info(f"🔀 Перенос #{run_id}: {len(moves)} клиентов ({server_type})")
+    _spawn(execute_run(bot, run_id))
+    return run_id
+
+
+async def resume_rebalance(bot: Bot) -> List[int]:
+    """Продолжить незавершённые переносы (после перезапуска бота)"""
+    runs = await get_unfinished_rebalance_runs()
+    for run in runs:
+        _spawn(execute_run(bot, run['id']))
+    return [run['id'] for run in runs]
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _schedule_run(bot: Bot, run_id: int, delay: float):
+    if run_id in _scheduled_runs:
+        return
+    _scheduled_runs.add(run_id)
+
+    async def run_later():
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            _scheduled_runs.discard(run_id)
+        await execute_run(bot, run_id)
+
+    _spawn(run_later())
+
+
+async def execute_run(bot: Bot, run_id: int):
+    """Один проход по незавершённым перемещениям пачками с паузой между ними"""
+    async with _run_lock, rebalance_run_lock(run_id) as acquired:
+        if not acquired:
+            # Каждый процесс бота при старте подхватывает все незавершённые переносы —
+            # ведёт перенос тот, кто первым взял блокировку
+            logger.info(f"🔀 Перенос #{run_id} уже выполняется другим процессом")
+            return
+        moves = await get_rebalance_moves(run_id, UNFINISHED_STATUSES)
+        for i in range(0, len(moves), REBALANCE_BATCH_SIZE):
+            if i:
+                await asyncio.sleep(REBALANCE_BATCH_INTERVAL_SECONDS)
+            await asyncio.gather(*(_advance(bot, move) for move in moves[i:i + REBALANCE_BATCH_SIZE]))
+
+        left = await get_rebalance_moves(run_id, UNFINISHED_STATUSES)
+        grace_ends = [
+            m['notified_at'] + timedelta(seconds=REBALANCE_GRACE_SECONDS)
+            for m in left if m['status'] == 'switched' and m['notified_at'] is not None
+        ]
+        if grace_ends:
+            # Старые клиенты удалим следующим проходом, когда у первых из них кончится льготный период
+            delay = max((min(grace_ends) - datetime.now()).total_seconds(), REBALANCE_BATCH_INTERVAL_SECONDS)
+            _schedule_run(bot, run_id, delay)
+        if len(left) > len(grace_ends):
+            # Панели недоступны и т.п. — продолжим при следующем /rebalance resume или старте бота
+            logger.warning(f"🔀 Перенос #{run_id}: не завершено {len(left) - len(grace_ends)} перемещений")
+        if left:
+            return
+        await finish_rebalance_run(run_id)
+        logger.info(f"🔀 Перенос #{run_id} завершён")
+
+
+async def _advance(bot: Bot, move: Dict):
+    """Довести перемещение до конца, начиная с сохранённого шага"""
+    try:
+        if move['status'] == 'creating':
+            await _recover_creating(move)
+        if move['status'] == 'pending':
+            await _create_on_target(move)
+        if move['status'] == 'created':
+            if not await switch_subscription_client(move):
+                # Подписку за это время продлили или заменили — новый клиент не нужен
+                move['status'] = 'failed'
+                async with _panel_limits[move['to_server_id']]:
+                    await delete_vless_user(move['new_uuid'], move['to_server_id'], move['to_inbound_id'])
+                return
+            move['status'] = 'switched'
+        if move['status'] == 'switched':
+            if move['notified_at'] is None:
+                await _notify_user(bot, move)
+            if datetime.now() < move['notified_at'] + timedelta(seconds=REBALANCE_GRACE_SECONDS):
+                # Даём время импортировать новый конфиг — старый удалим следующим проходом
+                return
+            async with _panel_limits[move['from_server_id']]:
+                deleted = await delete_vless_user(move['old_uuid'], move['from_server_id'], move['from_inbound_id'])
+                # delClient отвечает ошибкой и на уже удалённого клиента (бот упал до отметки done)
+                gone = deleted or await _old_client_gone(move)
+            if gone:
+                await update_rebalance_move(move['id'], status='done', error=None)
+            else:
+                await update_rebalance_move(move['id'], error='old client not deleted')
+    except Exception as e:
+        logger.error(f"Rebalance move {move['id']} failed at {move['status']}: {e}")
+        await update_rebalance_move(move['id'], error=str(e)[:255])
+
+
+async def _create_on_target(move: Dict):
+    server = get_server(move['to_server_id'])
+    if server is None or not is_available(server['id']):
+        move['status'] = 'failed'
+        await update_rebalance_move(move['id'], status='failed', error='target unavailable')
+        return
+
+    # uuid и email нового клиента сохраняем до запроса к панели — после падения по ним
+    # проверяется, успел ли клиент появиться
+    client = new_client()
+    move.update(status='creating', new_uuid=client['id'], new_email=client['email'])
+    await update_rebalance_move(move['id'], status='creating', new_uuid=client['id'], new_email=client['email'])
+
+    async with _panel_limits[server['id']]:
+        result = await provision_on_server(server, client, PRIORITY_MAINTENANCE)
+    if result is None:
+        move['status'] = 'failed'
+        await update_rebalance_move(move['id'], status='failed', error='target full or panel error')
+        return
+    move.update(status='created', to_inbound_id=result['inbound_id'], vpn_config=result['config'])
+    await update_rebalance_move(
+        move['id'], status='created', to_inbound_id=result['inbound_id'], vpn_config=result['config'], error=None
+    )
+
+
+async def _recover_creating(move: Dict):
+    """Бот упал между сохранением uuid и ответом панели — ищем клиента на целевом сервере"""
+    server = get_server(move['to_server_id'])
+    if server is None:
+        # Сервер удалён из реестра — ждать его бессмысленно, иначе перенос никогда не завершится
+        move['status'] = 'failed'
+        await update_rebalance_move(move['id'], status='failed', error='target unavailable')
+        return
+    inbounds = await fetch_inbounds(server)
+    if inbounds is None:
+        # Панель молчит — оставляем как есть до следующего прохода
+        return
+    for panel_inbound in inbounds:
+        if any(c.get('email') == move['new_email'] for c in inbound_clients(panel_inbound)):
+            inbound = get_inbound(server['id'], panel_inbound['id']) or {"inbound_id": panel_inbound['id']}
+            config = build_config(server, inbound, move['new_uuid'], move['new_email'])
+            move.update(status='created', to_inbound_id=panel_inbound['id'], vpn_config=config)
+            await update_rebalance_move(
+                move['id'], status='created', to_inbound_id=panel_inbound['id'], vpn_config=config
+            )
+            return
+    # Клиент не создан; возможно зависшее резервирование поправит сверка (utils/reconciler.py)
+    move.update(status='pending', new_uuid=None, new_email=None)
+    await update_rebalance_move(move['id'], status='pending', new_uuid=None, new_email=None)
+
+
+async def _old_client_gone(move: Dict) -> bool:
+    """Старого клиента уже нет: сервер удалён или на панели нет его uuid (место при этом уже освобождено)"""
+    server = get_server(move['from_server_id'])
+    if server is None:
+        return True
+    inbounds = await fetch_inbounds(server)
+    if inbounds is None:
+        # Панель молчит — повторим удаление при следующем проходе
+        return False
+    return not any(
+        c.get('id') == move['old_uuid']
+        for panel_inbound in inbounds
+        if move['from_inbound_id'] in (None, panel_inbound['id'])
+        for c in inbound_clients(panel_inbound)
+    )
+
+
+async def _notify_user(bot: Bot, move: Dict):
+    try:
+        await bot.send_message(
+            move['user_id'],
+            "🔀 <b>Ваш VPN перенесён на менее загруженный сервер</b>\n\n"
+            f"Старый конфиг перестанет работать примерно через {max(round(REBALANCE_GRACE_SECONDS / 60), 1)} мин — "
+            "импортируйте новый из файла ниже.",
+            parse_mode='HTML'
+        )
+        await bot.send_document(
+            move['user_id'],
+            BufferedInputFile(move['vpn_config'].encode('utf-8'), filename=f"vless_{move['user_id']}.txt"),
+            caption="Ваш новый VLESS конфиг (импортируйте в Nekobox, v2rayNG, Streisand и т.д.)"
+        )
+    except Exception as e:
+        # Пользователь заблокировал бота и т.п. — конфиг всё равно доступен в «Моя подписка»
+        logger.warning(f"Не удалось уведомить {move['user_id']} о переносе: {e}")
+    move['notified_at'] = datetime.now()
+    await update_rebalance_move(move['id'], notified_at=move['notified_at'])
+
+
+def init_rebalancer(bot: Bot):
+    """Подхватить переносы, прерванные остановкой бота"""
+    _spawn(resume_rebalance(bot))
+
+
+async def close_rebalancer():
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
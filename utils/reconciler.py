@@ -0,0 +1,174 @@
+# utils/reconciler.py — сверка current_load и клиентов подписок со списками клиентов панелей
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from database.db import get_inbound_loads, apply_load_corrections, get_expected_clients
+from config import RECONCILE_INTERVAL_SECONDS, RECONCILE_CONFIRM_DELAY_SECONDS
+from utils.server_registry import get_active_servers, get_server, load_servers
+from utils.panel_health import is_available
+from utils.vpn_manager import fetch_inbounds, inbound_clients, slot_mutations
+
+logger = logging.getLogger(__name__)
+
+_reconciler_task: Optional[asyncio.Task] = None
+_last_report: Optional[Dict[str, Any]] = None
+
+
+async def _fetch_panel_clients(server: Dict) -> Optional[Dict[int, Set[str]]]:
+    """inbound_id -> email'ы клиентов на панели (один запрос на панель)"""
+    inbounds = await fetch_inbounds(server)
+    if inbounds is None:
+        return None
+    return {
+        inbound['id']: {c['email'] for c in inbound_clients(inbound) if c.get('email')}
+        for inbound in inbounds
+    }
+
+
+def _server_name(server_id: Optional[int]) -> str:
+    server = get_server(server_id) if server_id else None
+    return server['name'] if server else str(server_id)
+
+
+async def _measure_drift(servers: List[Dict]) -> Tuple[
+    Dict[Tuple[int, int], int], Dict[int, Dict[int, Set[str]]], List[str], Set[Tuple[int, int]]
+]:
+    """Один замер: (server_id, inbound_id) -> клиентов на панели минус current_load в БД
+
+    Возвращает также клиентов панелей, неответившие панели и пропущенные inbound'ы.
+    """
+    # БД и панели снимаются в разные моменты: inbound'ы, где за это время шло резервирование,
+    # создание или удаление клиента в этом процессе, пропускаем
+    mutations_before = slot_mutations()
+    db_loads = await get_inbound_loads()
+
+    results = await asyncio.gather(
+        *(_fetch_panel_clients(server) for server in servers),
+        return_exceptions=True
+    )
+    panel_clients: Dict[int, Dict[int, Set[str]]] = {}
+    failed = []
+    for server, result in zip(servers, results):
+        if isinstance(result, Exception) or result is None:
+            failed.append(server['name'])
+        else:
+            panel_clients[server['id']] = result
+
+    mutations_after = slot_mutations()
+    unstable = {
+        key for key in mutations_before.keys() | mutations_after.keys()
+        if mutations_after.get(key) is None or mutations_before.get(key) != mutations_after.get(key)
+    }
+
+    drift = {}
+    for (server_id, inbound_id), db_load in db_loads.items():
+        inbounds = panel_clients.get(server_id)
+        if inbounds is None or (server_id, inbound_id) in unstable:
+            continue
+        actual = len(inbounds.get(inbound_id, ()))
+        if actual != db_load:
+            drift[(server_id, inbound_id)] = actual - db_load
+    return drift, panel_clients, failed, unstable
+
+
+async def reconcile() -> Dict[str, Any]:
+    """Один проход: сверить клиентов всех доступных панелей с БД и поправить current_load
+
+    Возвращает отчёт: поправки счётчиков, клиенты на панелях без подписки (orphans)
+    и подписки, клиента которых на панели нет (missing).
+    """
+    global _last_report
+    servers = [s for s in get_active_servers() if is_available(s['id'])]
+
+    expected = await get_expected_clients()
+    drift, panel_clients, failed, unstable = await _measure_drift(servers)
+
+    # Операции других процессов бота slot_mutations() не видит — их резервирование между
+    # замером БД и панели выглядит как расхождение. Такие расхождения временные, настоящее
+    # остаётся прежним: применяем только то, что повторный замер подтвердил
+    corrections = []
+    if drift:
+        await asyncio.sleep(RECONCILE_CONFIRM_DELAY_SECONDS)
+        drifted = {server_id for server_id, _ in drift}
+        confirmed, _, _, _ = await _measure_drift([s for s in servers if s['id'] in drifted])
+        corrections = [
+            (server_id, inbound_id, delta) for (server_id, inbound_id), delta in drift.items()
+            if confirmed.get((server_id, inbound_id)) == delta
+        ]
+    if corrections:
+        await apply_load_corrections(corrections)
+        # Реестр выбирает серверы по current_load — перечитываем исправленные значения
+        await load_servers()
+
+    emails_by_server = {
+        server_id: set().union(*inbounds.values()) if inbounds else set()
+        for server_id, inbounds in panel_clients.items()
+    }
+    all_panel_emails = set().union(*emails_by_server.values()) if emails_by_server else set()
+    expected_emails = {row['email'] for row in expected}
+
+    missing = []
+    for row in expected:
+        if row['server_id'] is not None:
+            if row['server_id'] in emails_by_server and row['email'] not in emails_by_server[row['server_id']]:
+                missing.append(row)
+        # Старые подписки без server_id: «нет нигде» можно утверждать, только если ответили все панели
+        elif not failed and row['email'] not in all_panel_emails:
+            missing.append(row)
+
+    orphans = [
+        (server_id, inbound_id, email)
+        for server_id, inbounds in panel_clients.items()
+        for inbound_id, emails in inbounds.items() if (server_id, inbound_id) not in unstable
+        for email in emails - expected_emails
+    ]
+
+    _last_report = {
+        "checked_at": datetime.now(),
+        "servers_checked": len(panel_clients),
+        "servers_failed": failed,
+        "inbounds_skipped": len(unstable),
+        "corrections_unconfirmed": len(drift) - len(corrections),
+        "corrections": [(_server_name(s), i, d) for s, i, d in corrections],
+        "orphans": [(_server_name(s), i, email) for s, i, email in orphans],
+        "missing": [
+            {**row, "server_name": _server_name(row['server_id'])}
+            for row in missing if row['source'] == 'subscription'
+        ],
+        "missing_pooled": sum(1 for row in missing if row['source'] == 'pool'),
+    }
+    log = logger.warning if corrections or orphans or missing or failed else logger.info
+    log(
+        f"🧮 Сверка панелей: {len(panel_clients)} ок, {len(failed)} без ответа, "
+        f"поправок {len(corrections)}, лишних клиентов {len(orphans)}, потерянных {len(missing)}"
+    )
+    return _last_report
+
+
+def get_last_report() -> Optional[Dict[str, Any]]:
+    return _last_report
+
+
+async def _reconciler():
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
+        try:
+            await reconcile()
+        except Exception as e:
+            logger.error(f"Reconciliation failed: {e}")
+
+
+def init_reconciler():
+    global _reconciler_task
+    if RECONCILE_INTERVAL_SECONDS > 0:
+        _reconciler_task = asyncio.create_task(_reconciler())
+
+
+async def close_reconciler():
+    global _reconciler_task
+    if _reconciler_task:
+        _reconciler_task.cancel()
+        await asyncio.gather(_reconciler_task, return_exceptions=True)
+        _reconciler_task = None
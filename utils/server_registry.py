@@ -0,0 +1,154 @@
+# utils/server_registry.py — реестр VLESS-серверов в памяти
+import heapq
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from database.db import get_all_servers as fetch_all_servers, get_all_inbounds
+from utils.panel_health import is_available
+
+logger = logging.getLogger(__name__)
+
+# server_id -> строка vless_servers (current_load поддерживается здесь на месте)
+_servers: Dict[int, Dict] = {}
+# Версия записи сервера: элементы кучи со старой версией считаются устаревшими
+_versions: Dict[int, int] = {}
+# Кучи по типу сервера: (load/max_clients, версия, server_id)
+_heaps: Dict[str, List[Tuple[float, int, int]]] = {}
+# server_id -> inbound'ы панели (строки vless_inbounds, current_load тоже поддерживается здесь)
+_inbounds: Dict[int, List[Dict]] = {}
+
+
+def _load_ratio(server: Dict) -> float:
+    return server['current_load'] / max(server['max_clients'] or 1, 1)
+
+
+def _push(server: Dict):
+    server_id = server['id']
+    _versions[server_id] = _versions.get(server_id, 0) + 1
+    if server['is_active']:
+        heap = _heaps.setdefault(server['type'], [])
+        heapq.heappush(heap, (_load_ratio(server), _versions[server_id], server_id))
+        # Куча копит устаревшие элементы — периодически пересобираем её из актуальных
+        if len(heap) > 4 * len(_servers) + 16:
+            heap[:] = [entry for entry in heap if _versions.get(entry[2]) == entry[1]]
+            heapq.heapify(heap)
+
+
+async def load_servers():
+    """(Пере)загрузить реестр из vless_servers — при старте, после добавления сервера и по таймеру"""
+    servers = await fetch_all_servers()
+    inbounds = await get_all_inbounds()
+    _servers.clear()
+    _heaps.clear()
+    _inbounds.clear()
+    for inbound in inbounds:
+        _inbounds.setdefault(inbound['server_id'], []).append(inbound)
+    for server in servers:
+        _servers[server['id']] = server
+        if server['id'] not in _inbounds:
+            logger.warning(f"У сервера {server['name']} (ID {server['id']}) нет inbound'ов — клиенты на него не попадут")
+        _push(server)
+    logger.info(f"🖥 Реестр серверов загружен: {len(servers)} шт.")
+
+
+def pick_server(server_type: str = "standard") -> Optional[Dict]:
+    """Наименее загруженный (по доле от max_clients) доступный сервер типа — O(log n), без БД"""
+    heap = _heaps.get(server_type)
+    while heap:
+        _, version, server_id = heap[0]
+        if _versions.get(server_id) == version:
+            if is_available(server_id):
+                return _servers[server_id]
+            # Вершина за открытым circuit breaker — берём лучший из доступных линейно
+            ranked = ranked_servers(server_type)
+            return ranked[0] if ranked else None
+        # Ленивое удаление устаревших элементов
+        heapq.heappop(heap)
+    return None
+
+
+def get_server(server_id: int) -> Optional[Dict]:
+    return _servers.get(server_id)
+
+
+def get_all_servers() -> List[Dict]:
+    return list(_servers.values())
+
+
+def get_active_servers(server_type: Optional[str] = None) -> List[Dict]:
+    return [
+        s for s in _servers.values()
+        if s['is_active'] and (server_type is None or s['type'] == server_type)
+    ]
+
+
+def adjust_server_load(server_id: int, delta: int):
+    """Учесть добавленных/удалённых клиентов (в БД current_load обновляет вызывающий)"""
+    server = _servers.get(server_id)
+    if server is None:
+        return
+    server['current_load'] = max(server['current_load'] + delta, 0)
+    _push(server)
+
+
+def mark_server_full(server_id: int):
+    """БД отказала в резервировании — считаем сервер заполненным до следующей сверки"""
+    server = _servers.get(server_id)
+    if server is None:
+        return
+    server['current_load'] = max(server['current_load'], server['max_clients'])
+    _push(server)
+
+
+def pick_inbound(server_id: int) -> Optional[Dict]:
+    """Наименее заполненный активный inbound сервера, в котором ещё есть место"""
+    candidates = [
+        i for i in _inbounds.get(server_id, [])
+        if i['is_active'] and i['current_load'] < i['max_clients']
+    ]
+    return min(candidates, key=_load_ratio, default=None)
+
+
+def free_slots(server_id: int) -> int:
+    """Сколько мест можно занять одним резервированием: в inbound'е, который выберет pick_inbound, и на сервере"""
+    server = _servers.get(server_id)
+    inbound = pick_inbound(server_id)
+    if server is None or inbound is None:
+        return 0
+    return max(min(
+        inbound['max_clients'] - inbound['current_load'],
+        server['max_clients'] - server['current_load']
+    ), 0)
+
+
+def get_inbound(server_id: int, inbound_id: int) -> Optional[Dict]:
+    for inbound in _inbounds.get(server_id, []):
+        if inbound['inbound_id'] == inbound_id:
+            return inbound
+    return None
+
+
+def get_inbounds(server_id: int) -> List[Dict]:
+    return list(_inbounds.get(server_id, []))
+
+
+def adjust_inbound_load(server_id: int, inbound_id: int, delta: int):
+    """Учесть клиентов в inbound и на сервере в целом"""
+    inbound = get_inbound(server_id, inbound_id)
+    if inbound is not None:
+        inbound['current_load'] = max(inbound['current_load'] + delta, 0)
+    adjust_server_load(server_id, delta)
+
+
+def mark_inbound_full(server_id: int, inbound_id: int):
+    inbound = get_inbound(server_id, inbound_id)
+    if inbound is not None:
+        inbound['current_load'] = max(inbound['current_load'], inbound['max_clients'])
+
+
+def ranked_servers(server_type: str) -> List[Dict]:
+    """Доступные активные серверы типа по возрастанию загрузки (запасной путь, когда вершина кучи не подходит)"""
+    return sorted(
+        (s for s in get_active_servers(server_type) if is_available(s['id'])),
+        key=_load_ratio
+    )
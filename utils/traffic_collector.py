@@ -0,0 +1,97 @@
+# utils/traffic_collector.py — сбор трафика клиентов с панелей 3X-UI
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Set
+
+from database.db import get_traffic_counters, save_traffic_samples, rollup_traffic
+from config import (
+    TRAFFIC_COLLECT_INTERVAL_SECONDS, TRAFFIC_HOURLY_RETENTION_HOURS, TRAFFIC_WRITE_BATCH_SIZE
+)
+from utils.server_registry import get_active_servers
+from utils.panel_health import is_available
+from utils.vpn_manager import fetch_inbounds
+
+logger = logging.getLogger(__name__)
+
+_collector_task: Optional[asyncio.Task] = None
+# Серверы, с которых в этом процессе уже был хотя бы один сбор (в том числе без клиентов)
+_collected_servers: Set[int] = set()
+
+
+async def collect_server_traffic(server: Dict) -> int:
+    """Снять счётчики сервера и записать приращения с прошлого цикла; возвращает число активных клиентов"""
+    # Один запрос списка inbound'ов на панель — clientStats всех клиентов сразу
+    inbounds = await fetch_inbounds(server)
+    if inbounds is None:
+        return 0
+    stats = [stat for inbound in inbounds for stat in inbound.get("clientStats") or []]
+
+    previous = await get_traffic_counters(server['id'])
+    # Прошлый сбор был, если есть сохранённые счётчики: после него у каждого увиденного клиента
+    # есть строка. Тогда незнакомый email — клиент, созданный после сбора, и весь его счётчик —
+    # свежий трафик. Иначе (первый сбор после запуска) счётчики только запоминаются как точка
+    # отсчёта — трафик за всю прошлую жизнь клиента не должен попасть в «последние сутки»
+    collected_before = bool(previous) or server['id'] in _collected_servers
+    ts = datetime.now().replace(microsecond=0)
+    counters, deltas = [], []
+    for stat in stats:
+        email = stat.get("email")
+        if not email:
+            continue
+        up, down = int(stat.get("up") or 0), int(stat.get("down") or 0)
+        if email not in previous:
+            counters.append((email, up, down))
+            if collected_before and (up or down):
+                deltas.append((email, up, down))
+            continue
+        prev_up, prev_down = previous[email]
+        if (up, down) == (prev_up, prev_down):
+            continue
+        counters.append((email, up, down))
+        # Счётчик уменьшился — трафик клиента сбросили на панели, считаем с нуля
+        delta_up = up - prev_up if up >= prev_up else up
+        delta_down = down - prev_down if down >= prev_down else down
+        if delta_up or delta_down:
+            deltas.append((email, delta_up, delta_down))
+
+    if counters:
+        await save_traffic_samples(server['id'], ts, counters, deltas, TRAFFIC_WRITE_BATCH_SIZE)
+    _collected_servers.add(server['id'])
+    return len(deltas)
+
+
+async def collect_traffic():
+    """Один цикл: все доступные панели параллельно, затем даунсэмплинг"""
+    servers = [s for s in get_active_servers() if is_available(s['id'])]
+    results = await asyncio.gather(
+        *(collect_server_traffic(server) for server in servers),
+        return_exceptions=True
+    )
+    for server, result in zip(servers, results):
+        if isinstance(result, Exception):
+            logger.error(f"Traffic collection on {server['name']} failed: {result}")
+    await rollup_traffic(TRAFFIC_HOURLY_RETENTION_HOURS)
+
+
+async def _traffic_collector():
+    while True:
+        try:
+            await collect_traffic()
+        except Exception as e:
+            logger.error(f"Traffic collection failed: {e}")
+        await asyncio.sleep(TRAFFIC_COLLECT_INTERVAL_SECONDS)
+
+
+def init_traffic_collector():
+    global _collector_task
+    if TRAFFIC_COLLECT_INTERVAL_SECONDS > 0:
+        _collector_task = asyncio.create_task(_traffic_collector())
+
+
+async def close_traffic_collector():
+    global _collector_task
+    if _collector_task:
+        _collector_task.cancel()
+        await asyncio.gather(_collector_task, return_exceptions=True)
+        _collector_task = None
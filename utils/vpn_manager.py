@@ -1,11 +1,30 @@
 # utils/vless_manager.py
+import asyncio
 import aiohttp
+import json
+import time
 import uuid
 import logging
 import os
+from collections import defaultdict
 from dotenv import load_dotenv
-from database.db import get_active_servers, get_server_by_id
-from typing import Optional, Dict
+from database.db import (
+    get_server_by_id, reserve_server_capacity, release_server_capacity,
+    claim_pooled_client, add_pooled_clients, count_pooled_clients, purge_claimed_pooled_clients
+)
+from config import (
+    PANEL_CONNECTION_LIMIT, PANEL_KEEPALIVE_SECONDS, PANEL_REQUEST_TIMEOUT_SECONDS,
+    PANEL_SESSION_TTL_SECONDS, PANEL_BATCH_WINDOW_MS, PANEL_BATCH_MAX_CLIENTS,
+    WARM_POOL_SIZE_PER_SERVER, WARM_POOL_REFILL_INTERVAL_SECONDS, SERVER_REGISTRY_REFRESH_SECONDS,
+    PANEL_PROBE_INTERVAL_SECONDS, PROVISION_MAX_ATTEMPTS, PROVISION_HEDGE_ENABLED, PROVISION_HEDGE_DELAY_MS
+)
+from typing import Optional, Dict, Any, Tuple, List, Set
+from utils.server_registry import (
+    load_servers, pick_server, ranked_servers, get_server, get_active_servers, get_all_servers,
+    mark_server_full, pick_inbound, adjust_inbound_load, mark_inbound_full, free_slots
+)
+from utils.panel_health import is_available, record_success, record_failure, probe_panels
+from utils.panel_scheduler import get_scheduler, PRIORITY_CHECKOUT, PRIORITY_DEFAULT, PRIORITY_MAINTENANCE
 
 load_dotenv()
 logger = logging.getLogger(__name__)
@@ -13,106 +32,596 @@ logger = logging.getLogger(__name__)
 ADMIN_USER = os.getenv("VLESS_ADMIN_USERNAME")
 ADMIN_PASS = os.getenv("VLESS_ADMIN_PASSWORD")
 
+# Долгоживущие HTTP-клиенты панелей 3X-UI: server_id -> сессия со своим keep-alive пулом
+_panel_sessions: Dict[int, aiohttp.ClientSession] = {}
+
+# Кэш cookie сессий панелей: server_id -> ("имя=значение", момент истечения по time.monotonic())
+_panel_cookies: Dict[int, Tuple[str, float]] = {}
+_login_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Очереди пакетного создания клиентов: (server_id, inbound_id) -> ClientBatcher
+_client_batchers: Dict[Tuple[int, int], "ClientBatcher"] = {}
+_batch_tasks: Set[asyncio.Task] = set()
+
+# Изменения мест по (server_id, inbound_id): счётчик (растёт в начале и в конце каждой операции)
+# и число незавершённых операций — от резервирования до ответа панели, удаление вместе с
+# освобождением места. Сверка (utils/reconciler.py) пропускает inbound'ы, которые менялись,
+# пока она снимала БД и панели
+_slot_mutations: Dict[Tuple[int, int], int] = defaultdict(int)
+_slot_ops_open: Dict[Tuple[int, int], int] = defaultdict(int)
+
+# Удаление клиентов, проигравших гонку страхующих попыток
+_cleanup_tasks: Set[asyncio.Task] = set()
+
+# Резерв заранее созданных клиентов (таблица vless_client_pool) и его фоновое пополнение
+_warm_pool_wakeup = asyncio.Event()
+_background_tasks: List[asyncio.Task] = []
+
+
+def _new_panel_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=PANEL_CONNECTION_LIMIT,
+        keepalive_timeout=PANEL_KEEPALIVE_SECONDS
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=PANEL_REQUEST_TIMEOUT_SECONDS),
+        # Cookie панели передаём явно в заголовке; общий jar не нужен (и игнорирует IP-хосты)
+        cookie_jar=aiohttp.DummyCookieJar()
+    )
+
+
+def get_panel_session(server: Dict) -> aiohttp.ClientSession:
+    """HTTP-клиент панели (создаётся при первом обращении и переиспользуется)"""
+    session = _panel_sessions.get(server['id'])
+    if session is None or session.closed:
+        session = _panel_sessions[server['id']] = _new_panel_session()
+    return session
+
+
+async def init_vpn_manager():
+    """Загрузить реестр серверов и поднять клиентов активных панелей при старте бота"""
+    await load_servers()
+    for server in get_active_servers():
+        get_panel_session(server)
+    _background_tasks.append(asyncio.create_task(_server_registry_refresher()))
+    _background_tasks.append(asyncio.create_task(_panel_prober()))
+    if WARM_POOL_SIZE_PER_SERVER > 0:
+        _background_tasks.append(asyncio.create_task(_warm_pool_refiller()))
+
+
+async def _server_registry_refresher():
+    """Периодическая сверка реестра с БД (изменения из других процессов и ручные правки)"""
+    while True:
+        await asyncio.sleep(SERVER_REGISTRY_REFRESH_SECONDS)
+        try:
+            await load_servers()
+        except Exception as e:
+            logger.error(f"Server registry refresh failed: {e}")
+
+
+async def _panel_prober():
+    """Фоновая проверка всех панелей: RTT, здоровье и circuit breaker'ы"""
+    while True:
+        try:
+            await probe_panels(get_all_servers())
+        except Exception as e:
+            logger.error(f"Panel probe failed: {e}")
+        await asyncio.sleep(PANEL_PROBE_INTERVAL_SECONDS)
+
+
+async def close_vpn_manager():
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    # Даём дочистить клиентов, проигравших гонку, пока сессии панелей ещё открыты
+    await asyncio.gather(*_cleanup_tasks, return_exceptions=True)
+    sessions = list(_panel_sessions.values())
+    _panel_sessions.clear()
+    await asyncio.gather(*(session.close() for session in sessions), return_exceptions=True)
+
+
+def _panel_base_url(server: Dict) -> str:
+    return f"http://{server['ip']}:{server['port']}/{server['secret_path']}"
+
+
 async def login(session: aiohttp.ClientSession, server: Dict) -> Optional[str]:
-    url = f"http://{server['ip']}:{server['port']}/{server['secret_path']}/login"
+    """Вход в панель; при успехе cookie ("имя=значение") кладётся в кэш и возвращается"""
+    url = f"{_panel_base_url(server)}/login"
     data = {"username": ADMIN_USER, "password": ADMIN_PASS}
     try:
         async with session.post(url, data=data, timeout=10) as resp:
             text = await resp.text()
             if "success" in text.lower():
-                cookie = resp.headers.get("Set-Cookie")
-                if cookie:
-                    return cookie.split(";")[0].split("=")[1]
+                for morsel in resp.cookies.values():
+                    ttl = PANEL_SESSION_TTL_SECONDS
+                    if morsel['max-age'].isdigit():
+                        ttl = min(ttl, int(morsel['max-age']))
+                    cookie = f"{morsel.key}={morsel.value}"
+                    # Обновляем чуть раньше истечения, чтобы не ловить 401 на живом запросе
+                    _panel_cookies[server['id']] = (cookie, time.monotonic() + ttl * 0.9)
+                    return cookie
     except Exception as e:
         logger.error(f"Login failed for {server['name']}: {e}")
     return None
 
-async def create_vless_user(server_type: str = "standard") -> Optional[Dict]:
-    servers = await get_active_servers(server_type)
-    if not servers:
+
+async def get_panel_cookie(server: Dict, stale: Optional[str] = None) -> Optional[str]:
+    """Cookie сессии панели из кэша; логин — только если её нет, она истекла или равна stale"""
+    def cached_cookie() -> Optional[str]:
+        cached = _panel_cookies.get(server['id'])
+        if cached and cached[0] != stale and time.monotonic() < cached[1]:
+            return cached[0]
         return None
 
-    # Выбираем наименее загруженный
-    server = min(servers, key=lambda x: x['current_load'])
+    cookie = cached_cookie()
+    if cookie:
+        return cookie
+    # Один логин на сервер: остальные конкурентные запросы дождутся его результата
+    async with _login_locks[server['id']]:
+        return cached_cookie() or await login(get_panel_session(server), server)
+
 
-    async with aiohttp.ClientSession() as session:
-        cookie = await login(session, server)
+def _is_auth_failure(resp: aiohttp.ClientResponse) -> bool:
+    if resp.status == 401:
+        return True
+    return resp.status in (301, 302, 303, 307, 308) and "login" in resp.headers.get("Location", "")
+
+
+async def panel_request(server: Dict, path: str, method: str = "POST", check_circuit: bool = True,
+                        priority: Optional[int] = PRIORITY_DEFAULT, **kwargs) -> Tuple[int, Optional[Any]]:
+    """Запрос к API панели с кэшированной сессией и прозрачным перелогином
+
+    Возвращает (HTTP-статус, JSON-ответ или None). Статус 0 — войти в панель не удалось,
+    503 — панель исключена circuit breaker'ом и запрос не отправлялся. С check_circuit=False
+    (проба здоровья) breaker не проверяется и не обновляется.
+
+    Запрос ждёт слот планировщика панели с приоритетом priority; None — без очереди.
+    """
+    if check_circuit and not is_available(server['id']):
+        return 503, None
+    try:
+        if priority is None:
+            status, body = await _panel_request(server, path, method, **kwargs)
+        else:
+            async with get_scheduler(server['id']).slot(priority):
+                status, body = await _panel_request(server, path, method, **kwargs)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        if check_circuit:
+            record_failure(server['id'])
+        raise
+    if check_circuit:
+        if status == 0 or status >= 500:
+            record_failure(server['id'])
+        else:
+            record_success(server['id'])
+    return status, body
+
+
+async def _panel_request(server: Dict, path: str, method: str, **kwargs) -> Tuple[int, Optional[Any]]:
+    session = get_panel_session(server)
+    url = f"{_panel_base_url(server)}/{path}"
+    headers = {"Accept": "application/json", **kwargs.pop("headers", {})}
+    stale = None
+    for _ in range(2):
+        cookie = await get_panel_cookie(server, stale=stale)
         if not cookie:
+            return 0, None
+        async with session.request(
+            method, url, headers={**headers, "Cookie": cookie}, allow_redirects=False, **kwargs
+        ) as resp:
+            if _is_auth_failure(resp):
+                # Сессия протухла на стороне панели — перелогиниваемся один раз
+                stale = cookie
+                continue
+            try:
+                body = await resp.json(content_type=None)
+            except ValueError:
+                body = None
+            return resp.status, body
+    return 401, None
+
+
+def _panel_ok(status: int, body: Optional[Any]) -> bool:
+    return status == 200 and (not isinstance(body, dict) or body.get("success", True))
+
+
+async def fetch_inbounds(server: Dict, priority: int = PRIORITY_MAINTENANCE) -> Optional[List[Dict]]:
+    """Все inbound'ы панели одним запросом — с settings (клиенты) и clientStats (трафик)"""
+    status, body = await panel_request(server, "panel/api/inbounds/list", method="GET", priority=priority)
+    if not _panel_ok(status, body):
+        logger.error(f"inbounds/list on {server['name']} failed: HTTP {status}")
+        return None
+    return body.get("obj") or []
+
+
+def inbound_clients(inbound: Dict) -> List[Dict]:
+    """Клиенты inbound'а из его settings (3X-UI отдаёт их JSON-строкой)"""
+    settings = inbound.get("settings") or {}
+    if isinstance(settings, str):
+        try:
+            settings = json.loads(settings)
+        except ValueError:
+            return []
+    return settings.get("clients") or []
+
+
+async def _add_clients(server: Dict, inbound: Dict, clients: List[Dict], priority: int) -> bool:
+    """Один addClient на пачку клиентов (места под них уже зарезервированы вызывающим)"""
+    payload = {
+        "id": inbound['inbound_id'],
+        "settings": json.dumps({"clients": clients})
+    }
+    status, body = await panel_request(server, "panel/api/inbounds/addClient", priority=priority, json=payload)
+    if not _panel_ok(status, body):
+        logger.error(f"addClient on {server['name']}/{inbound['inbound_id']} failed: HTTP {status} {body}")
+        return False
+    return True
+
+
+def _hold_slots(server: Dict, count: int = 1) -> Optional[Dict]:
+    """Сразу учесть места в реестре — параллельные покупки видят рост загрузки ещё до ответа БД
+
+    Без этого все одновременные покупки выбирают одну и ту же вершину кучи.
+    """
+    inbound = pick_inbound(server['id'])
+    if inbound is None:
+        mark_server_full(server['id'])
+        return None
+    adjust_inbound_load(server['id'], inbound['inbound_id'], count)
+    return inbound
+
+
+async def _reserve_slots(server: Dict, count: int = 1, inbound: Optional[Dict] = None) -> Optional[Dict]:
+    """Занять места на сервере и в наименее заполненном его inbound до обращения к панели
+
+    inbound — места в нём уже учтены в реестре через _hold_slots(). Возвращает inbound,
+    в котором заняты места, или None, если места нет. Операция над inbound'ом остаётся
+    открытой до _settle_slots().
+    """
+    server_checked = False
+    while True:
+        if inbound is None:
+            inbound = _hold_slots(server, count)
+            if inbound is None:
+                return None
+        key = (server['id'], inbound['inbound_id'])
+        _begin_slot_mutation(key)
+        try:
+            reserved = await reserve_server_capacity(server['id'], inbound['inbound_id'], count)
+        except Exception:
+            _end_slot_mutation(key)
+            adjust_inbound_load(server['id'], inbound['inbound_id'], -count)
+            raise
+        if reserved:
+            return inbound
+        _end_slot_mutation(key)
+        adjust_inbound_load(server['id'], inbound['inbound_id'], -count)
+        if not server_checked:
+            # Отказ мог быть по серверу целиком — один раз смотрим его строку,
+            # а не перебираем inbound'ы с запросом к БД на каждый
+            server_checked = True
+            row = await get_server_by_id(server['id'])
+            if row is None or not row['is_active'] or row['current_load'] + count > row['max_clients']:
+                mark_server_full(server['id'])
+                return None
+        if count > 1:
+            # Пачка не влезла — это ещё не значит, что мест нет совсем; реестр поправит перечитывание
             return None
+        mark_inbound_full(server['id'], inbound['inbound_id'])
+        inbound = None
 
-        user_uuid = str(uuid.uuid4())
-        email = f"user_{user_uuid[:8]}"
 
-        url = f"http://{server['ip']}:{server['port']}/{server['secret_path']}/panel/api/inbounds/addClient"
-        headers = {
-            "Cookie": f"session={cookie}",
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-        payload = {
-            "id": 1,
-            "settings": json.dumps({
-                "clients": [{
-                    "id": user_uuid,
-                    "flow": "xtls-rprx-vision",
-                    "email": email,
-                    "limitIp": 5,
-                    "totalGB": 0,
-                    "expiryTime": 0,
-                    "enable": True,
-                    "tgId": "",
-                    "subId": "",
-                    "reset": 0
-                }]
-            })
-        }
+def _settle_slots(server_id: int, inbound_id: int):
+    """Клиенты созданы на панели (или места уже освобождены) — операция над inbound'ом завершена"""
+    _end_slot_mutation((server_id, inbound_id))
 
+
+def _begin_slot_mutation(key: Tuple[int, int]):
+    _slot_mutations[key] += 1
+    _slot_ops_open[key] += 1
+
+
+def _end_slot_mutation(key: Tuple[int, int]):
+    _slot_ops_open[key] -= 1
+    if _slot_ops_open[key] <= 0:
+        del _slot_ops_open[key]
+    _slot_mutations[key] += 1
+
+
+def slot_mutations() -> Dict[Tuple[int, int], Optional[int]]:
+    """Снимок счётчиков изменений; None — над inbound'ом сейчас идёт операция"""
+    return {key: None if key in _slot_ops_open else n for key, n in _slot_mutations.items()}
+
+
+async def _release_slots(server: Dict, inbound_id: int, count: int = 1):
+    key = (server['id'], inbound_id)
+    _begin_slot_mutation(key)
+    try:
+        await release_server_capacity(server['id'], inbound_id, count)
+        adjust_inbound_load(server['id'], inbound_id, -count)
+    finally:
+        _end_slot_mutation(key)
+
+
+def _candidate_servers(server_type: str):
+    """Серверы по возрастанию загрузки: вершина кучи, остальные — только если она заполнена"""
+    first = pick_server(server_type)
+    if first is None:
+        return
+    yield first
+    for server in ranked_servers(server_type):
+        if server['id'] != first['id']:
+            yield server
+
+
+class ClientBatcher:
+    """Очередь создания клиентов одной панели
+
+    Клиенты, пришедшие в пределах PANEL_BATCH_WINDOW_MS (но не больше
+    PANEL_BATCH_MAX_CLIENTS), уходят одним addClient; каждый вызывающий
+    получает результат через свой future.
+    """
+
+    def __init__(self, server: Dict, inbound: Dict):
+        self.server = server
+        self.inbound = inbound
+        self._pending: List[Tuple[Dict, int, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    async def add(self, client: Dict, priority: int = PRIORITY_CHECKOUT) -> bool:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((client, priority, future))
+        if len(self._pending) >= PANEL_BATCH_MAX_CLIENTS:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(PANEL_BATCH_WINDOW_MS / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            _batch_tasks.add(task)
+            task.add_done_callback(_batch_tasks.discard)
+
+    async def _send(self, batch: List[Tuple[Dict, int, asyncio.Future]]):
+        # Пачка идёт с приоритетом самого важного из её клиентов
+        priority = min(priority for _, priority, _ in batch)
         try:
-            async with session.post(url, headers=headers, json=payload) as resp:
-                if resp.status == 200:
-                    # Обновляем нагрузку
-                    from database.db import pool
-                    async with pool.acquire() as conn:
-                        async with conn.cursor() as cur:
-                            await cur.execute("UPDATE vless_servers SET current_load = current_load + 1 WHERE id = %s", (server['id'],))
-                            await conn.commit()
-
-                    config = f"vless://{user_uuid}@{server['ip']}:{server['port']}?security=reality&encryption=none&pbk={server['pbk']}&headerType=none&fp=randomized&type=tcp&flow=xtls-rprx-vision&sni=yahoo.com&sid={server['sid'] or ''}#VPNBot-{email}"
-
-                    return {
-                        "config": config,
-                        "uuid": user_uuid,
-                        "email": email,
-                        "server_id": server['id'],
-                        "server_name": server['name']
-                    }
+            ok = await _add_clients(self.server, self.inbound, [client for client, _, _ in batch], priority)
         except Exception as e:
-            logger.error(f"Failed to create user on {server['name']}: {e}")
-    return None
+            logger.error(f"Failed to create {len(batch)} user(s) on {self.server['name']}: {e}")
+            ok = False
+        for _, _, future in batch:
+            # Вызывающий мог уже отменить ожидание
+            if not future.done():
+                future.set_result(ok)
 
-async def delete_vless_user(uuid: str, server_id: int):
-    server = await get_server_by_id(server_id)
-    if not server:
-        return False
 
-    async with aiohttp.ClientSession() as session:
-        cookie = await login(session, server)
-        if not cookie:
-            return False
+def _get_batcher(server: Dict, inbound: Dict) -> ClientBatcher:
+    key = (server['id'], inbound['inbound_id'])
+    batcher = _client_batchers.get(key)
+    if batcher is None:
+        batcher = _client_batchers[key] = ClientBatcher(server, inbound)
+    batcher.server, batcher.inbound = server, inbound
+    return batcher
+
+
+def new_client() -> Dict:
+    user_uuid = str(uuid.uuid4())
+    return {
+        "id": user_uuid,
+        "flow": "xtls-rprx-vision",
+        "email": f"user_{user_uuid[:8]}",
+        "limitIp": 5,
+        "totalGB": 0,
+        "expiryTime": 0,
+        "enable": True,
+        "tgId": "",
+        "subId": "",
+        "reset": 0
+    }
+
+
+def build_config(server: Dict, inbound: Dict, user_uuid: str, email: str) -> str:
+    port = inbound.get('port') or server['port']
+    return f"vless://{user_uuid}@{server['ip']}:{port}?security=reality&encryption=none&pbk={server['pbk']}&headerType=none&fp=randomized&type=tcp&flow=xtls-rprx-vision&sni=yahoo.com&sid={server['sid'] or ''}#VPNBot-{email}"
+
+
+async def provision_on_server(server: Dict, client: Optional[Dict] = None,
+                              priority: int = PRIORITY_CHECKOUT, inbound: Optional[Dict] = None) -> Optional[Dict]:
+    """Одна попытка: занять место и создать клиента (новым или заранее сгенерированным) на конкретном сервере
+
+    inbound — место, уже учтённое в реестре через _hold_slots().
+    """
+    inbound = await _reserve_slots(server, inbound=inbound)
+    if inbound is None:
+        return None
+
+    client = client or new_client()
+    try:
+        created = await _get_batcher(server, inbound).add(client, priority)
+        if not created:
+            await _release_slots(server, inbound['inbound_id'])
+            return None
+    finally:
+        _settle_slots(server['id'], inbound['inbound_id'])
+
+    return {
+        "config": build_config(server, inbound, client['id'], client['email']),
+        "uuid": client['id'],
+        "email": client['email'],
+        "server_id": server['id'],
+        "inbound_id": inbound['inbound_id'],
+        "server_name": server['name']
+    }
+
+
+def _discard_orphan(task: asyncio.Task):
+    """Попытка уже никому не нужна — если она всё же создала клиента, удаляем его с панели"""
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    if result:
+        logger.info(f"Удаляю лишнего клиента {result['email']} с сервера {result['server_name']}")
+        cleanup = asyncio.create_task(
+            delete_vless_user(result['uuid'], result['server_id'], result['inbound_id'])
+        )
+        _cleanup_tasks.add(cleanup)
+        cleanup.add_done_callback(_cleanup_tasks.discard)
+
+
+async def create_vless_user(server_type: str = "standard") -> Optional[Dict]:
+    # Сначала — готовый клиент из резерва: один UPDATE вместо HTTP к панели. Только с серверов,
+    # чья панель не за открытым circuit breaker — обычно это тот же хост, что и VPN-узел
+    available = [s['id'] for s in get_active_servers(server_type) if is_available(s['id'])]
+    pooled = await claim_pooled_client(server_type, available)
+    if pooled:
+        _warm_pool_wakeup.set()
+        return {
+            "config": pooled['vpn_config'],
+            "uuid": pooled['client_uuid'],
+            "email": pooled['email'],
+            "server_id": pooled['server_id'],
+            "inbound_id": pooled['inbound_id'],
+            "server_name": pooled['server_name']
+        }
+
+    # Серверы по возрастанию загрузки; при сбое — следующий (failover). В режиме
+    # PROVISION_HEDGE_ENABLED медленная попытка не ждётся дольше PROVISION_HEDGE_DELAY_MS:
+    # параллельно запускается попытка на следующем сервере, побеждает первая успешная
+    candidates = _candidate_servers(server_type)
+    in_flight: Set[asyncio.Task] = set()
+    exhausted = False
+    # PROVISION_MAX_ATTEMPTS ограничивает запущенные попытки, а не просмотренные серверы:
+    # кандидат без свободного места попыткой не считается
+    started = 0
+
+    def launch_next() -> bool:
+        nonlocal exhausted, started
+        while True:
+            server = next(candidates, None) if started < PROVISION_MAX_ATTEMPTS else None
+            if server is None:
+                exhausted = True
+                return False
+            # Место учитывается в реестре сразу при выборе: задача стартует позже, а следующие
+            # покупки должны уже видеть этот сервер более загруженным
+            inbound = _hold_slots(server)
+            if inbound is not None:
+                started += 1
+                in_flight.add(asyncio.create_task(provision_on_server(server, inbound=inbound)))
+                return True
+
+    try:
+        launch_next()
+        while in_flight:
+            hedge = PROVISION_HEDGE_ENABLED and len(in_flight) == 1 and not exhausted
+            done, _ = await asyncio.wait(
+                in_flight,
+                timeout=PROVISION_HEDGE_DELAY_MS / 1000 if hedge else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                # Порог задержки пройден — страхующая попытка на следующем сервере
+                launch_next()
+                continue
+
+            for task in done:
+                in_flight.discard(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    logger.error(f"Provisioning attempt failed: {e}")
+                    result = None
+                if result:
+                    return result
+
+            if not in_flight:
+                launch_next()
+        return None
+    finally:
+        # Оставшиеся попытки проиграли гонку (или вызывающий отменён) — не бросаем их клиентов
+        for task in in_flight:
+            task.add_done_callback(_discard_orphan)
 
-        url = f"http://{server['ip']}:{server['port']}/{server['secret_path']}/panel/api/inbounds/1/delClient/{uuid}"
-        headers = {"Cookie": f"session={cookie}"}
 
+async def refill_warm_pool():
+    """Досоздать клиентов в резерв до WARM_POOL_SIZE_PER_SERVER на каждом активном сервере"""
+    available = await count_pooled_clients()
+    for server in get_active_servers():
+        missing = WARM_POOL_SIZE_PER_SERVER - available.get(server['id'], 0)
+        while missing > 0:
+            # Пачка не больше свободного места в inbound'е — иначе БД откажет, хотя места есть
+            count = min(missing, PANEL_BATCH_MAX_CLIENTS, free_slots(server['id']))
+            if count <= 0:
+                break
+            clients = [new_client() for _ in range(count)]
+            inbound = await _reserve_slots(server, len(clients))
+            if inbound is None:
+                break
+            try:
+                created = await _add_clients(server, inbound, clients, PRIORITY_MAINTENANCE)
+                if not created:
+                    await _release_slots(server, inbound['inbound_id'], len(clients))
+            finally:
+                _settle_slots(server['id'], inbound['inbound_id'])
+            if not created:
+                break
+            await add_pooled_clients([
+                {
+                    "server_id": server['id'],
+                    "inbound_id": inbound['inbound_id'],
+                    "server_type": server['type'],
+                    "uuid": c['id'],
+                    "email": c['email'],
+                    "config": build_config(server, inbound, c['id'], c['email'])
+                }
+                for c in clients
+            ])
+            missing -= len(clients)
+    await purge_claimed_pooled_clients()
+
+
+async def _warm_pool_refiller():
+    """Фоновое пополнение резерва: по таймеру и сразу после каждого забранного клиента"""
+    while True:
         try:
-            async with session.post(url, headers=headers) as resp:
-                if resp.status == 200:
-                    # Уменьшаем нагрузку
-                    from database.db import pool
-                    async with pool.acquire() as conn:
-                        async with conn.cursor() as cur:
-                            await cur.execute("UPDATE vless_servers SET current_load = GREATEST(current_load - 1, 0) WHERE id = %s", (server_id,))
-                            await conn.commit()
-                    return True
-        except:
+            await asyncio.wait_for(_warm_pool_wakeup.wait(), timeout=WARM_POOL_REFILL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
             pass
-    return False
\ No newline at end of file
+        _warm_pool_wakeup.clear()
+        try:
+            await refill_warm_pool()
+        except Exception as e:
+            logger.error(f"Warm pool refill failed: {e}")
+
+async def delete_vless_user(uuid: str, server_id: int, inbound_id: Optional[int] = None,
+                            priority: int = PRIORITY_MAINTENANCE):
+    server = get_server(server_id) or await get_server_by_id(server_id)
+    if not server:
+        return False
+
+    # Подписки до шардирования inbound не записывали — все они жили в inbound 1
+    inbound_id = inbound_id or 1
+    # Удаление на панели и освобождение места в БД — одна операция для сверки
+    key = (server['id'], inbound_id)
+    _begin_slot_mutation(key)
+    try:
+        status, body = await panel_request(
+            server, f"panel/api/inbounds/{inbound_id}/delClient/{uuid}", priority=priority
+        )
+        if _panel_ok(status, body):
+            # Освобождаем место на сервере и в inbound
+            await _release_slots(server, inbound_id)
+            return True
+    except Exception as e:
+        logger.error(f"Failed to delete user on {server['name']}: {e}")
+    finally:
+        _end_slot_mutation(key)
+    return False